@@ -0,0 +1,90 @@
+# Compares get_data.parse_html against the earlier slicing parser.
+# Usage: python benchmarks/parse_html.py [saved_page.html ...]
+# Without arguments, a synthetic 100-row ranking page is used.
+
+from pathlib import Path
+from timeit import timeit
+
+import random
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from get_data import parse_html, ID_TAG_PREFIX, ID_TAG_START, ID_TAG_END, \
+                      RATING_TAG_PREFIX, RATING_TAG_START, RATING_TAG_END, \
+                      NAME_TAG_PREFIX, NAME_TAG_START, NAME_TAG_END, \
+                      NATION_TAG_PREFIX, NATION_TAG_START, NATION_TAG_END, BURN_PREFIX
+
+NUM_ROWS = 100
+REPEATS = 50
+
+def parse_html_slicing(h):
+  data = []
+  pos = h.find(ID_TAG_PREFIX)
+  while (pos != -1):
+    pos = h.find(ID_TAG_PREFIX)
+    h = h[pos : ]
+    start_pos = h.find(ID_TAG_START) + 1
+    end_pos = h.find(ID_TAG_END)
+    rank = int(h[start_pos : end_pos].strip())
+    h = h[end_pos : ]
+
+    pos = h.find(RATING_TAG_PREFIX)
+    h = h[pos : ]
+    start_pos = h.find(RATING_TAG_START) + 1
+    end_pos = h.find(RATING_TAG_END)
+    rating = int(h[start_pos : end_pos].strip())
+    h = h[end_pos : ]
+
+    pos = h.find(NAME_TAG_PREFIX)
+    h = h[pos : ]
+    start_pos = h.find(NAME_TAG_START) + 1
+    end_pos = h.find(NAME_TAG_END)
+    name = h[start_pos : end_pos].strip()
+
+    pos = h.find(NATION_TAG_PREFIX)
+    h = h[pos : ]
+    start_pos = h.find(NATION_TAG_START) + 1
+    end_pos = h.find(NATION_TAG_END)
+    nation = h[start_pos : end_pos].strip()
+
+    pos = h.find(BURN_PREFIX)
+    h = h[pos + len(BURN_PREFIX) : ]
+
+    player_text = str(rank) + ',' + str(rating) + ',' + name + ',' + nation
+    data.append(player_text + '\n')
+
+    pos = h.find(ID_TAG_PREFIX)
+  return data
+
+
+def synthetic_page(num_rows):
+  random.seed(num_rows)
+  rows = []
+  for i in range(1, num_rows + 1):
+    name = 'Player ' + str(i)
+    if i % 10 == 0:
+      name = 'Player, Jr., ' + str(i)
+    rows.append('<tr><td class="rankings-table__pos">' + str(i) + '</td>' \
+                + '<td class="rankings-table__rating"> ' + str(random.randint(100, 900)) \
+                + ' </td><td class="players">' + name + '</a></td>' \
+                + '<td class="nationality"><img src="flag.png" alt="' \
+                + random.choice(['AUS', 'ENG', 'IND']) + '"></td>' \
+                + '<td class="rankings-table__career">' + 'x' * 200 + '</td></tr>\n')
+  return '<html><table>\n' + ''.join(rows) + '</table>' + ' ' * 20000 + '</html>'
+
+
+pages = {p: Path(p).read_text() for p in sys.argv[1 : ]}
+if not pages:
+  pages = {'synthetic ' + str(NUM_ROWS) + ' rows': synthetic_page(NUM_ROWS)}
+
+for label, page in pages.items():
+  rows = parse_html(page)
+  assert rows == parse_html_slicing(page), "Rows differ from the slicing parser: " + label
+
+  slicing_time = timeit(lambda: parse_html_slicing(page), number = REPEATS) / REPEATS
+  offset_time = timeit(lambda: parse_html(page), number = REPEATS) / REPEATS
+  print (label + ':\t' + str(len(rows)) + ' rows, ' + str(len(page)) + ' chars')
+  print ('\tslicing: ' + '{:.3f}'.format(slicing_time * 1000) + ' ms' \
+          + '\toffsets: ' + '{:.3f}'.format(offset_time * 1000) + ' ms' \
+          + '\tspeedup: ' + '{:.1f}'.format(slicing_time / offset_time) + 'x')
@@ -1,7 +1,22 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+                                FIRST_COMPLETED, wait
 from datetime import date, timedelta
+from multiprocessing import get_all_start_methods, get_context
+from os import cpu_count, replace
 from pathlib import Path
+from zipfile import ZipFile
 
-import math
+import io
+import json
+import numpy as np
+import shutil
+import sys
+
+# Dates, player files and archives are decoded with the same helpers as utils/
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'utils'))
+
+from common.dates import string_to_date
+from common.readers import read_day_lines, read_player_archive, read_player_file
 
 # ['batting', 'bowling', 'allrounder']
 TYPE = {'batting', 'bowling', 'allrounder'}
@@ -16,6 +31,19 @@ END_DATE = date(2026, 1, 1)
 
 SUFFIX = ''
 
+# Player rows held in memory before they are appended to staged player files
+FLUSH_ROWS = 500000
+
+# Processes running parse and allrounder tasks: 0 for one per CPU, 1 to run serially
+NUM_WORKERS = 0
+
+# Write one compressed players/<type>/<format>.npz archive per type and format
+# instead of one file per player
+ARCHIVE = False
+
+# Only parse days after the last build of each type and format, and append them to players/
+INCREMENTAL = False
+
 VALIDATION = True
 # See README for when to use this flag
 SKIP_VALIDATION_FOR_TESTS = True
@@ -56,162 +84,382 @@ def get_file_lines(filename):
   return lines
 
 
-def parse_date(d, typ, frmt, data):
-  (yr, mn, dy) = date_to_parts(d)
-  date_str = yr + mn + dy
-  filename = 'data' + SUFFIX + '/' + typ + '/' + frmt + '/' + date_str + '.csv'
-  lines = get_file_lines(filename)
+def get_watermark_file():
+  return Path('players' + SUFFIX + '/watermarks.json')
 
-  if not lines:
-    return
+def read_watermarks():
+  # Exclusive end date of the last build, by type and format
+  watermark_file = get_watermark_file()
+  if not watermark_file.exists():
+    return {}
+  with watermark_file.open('r') as f:
+    return json.load(f)
 
-  for l in lines:
-    parts = l.strip().split(',')
-    rank = eval(parts[0])
-    rating = eval(parts[1])
-    name = fix_name(parts[2])
-    if (len(parts) > 4):
-      for i in range(3, len(parts) - 1):
-        name += '_' + fix_name(parts[i])
-    country = parts[len(parts) - 1]
+def write_watermark(typ, frmt, end_date):
+  watermarks = read_watermarks()
+  (yr, mn, dy) = date_to_parts(end_date)
+  watermarks[typ + '_' + frmt] = yr + mn + dy
 
-    key = country + ' ' + name
-    if key not in data:
-      data[key] = {}
-      data[key]['country'] = country
-      data[key]['name'] = name
-      data[key]['ratings'] = {}
-    data[key]['ratings'][date_str] = {}
-    data[key]['ratings'][date_str]['rank'] = rank
-    data[key]['ratings'][date_str]['rating'] = rating
+  watermark_file = get_watermark_file()
+  watermark_file.parent.mkdir(exist_ok = True, parents = True)
+  with watermark_file.open('w') as f:
+    json.dump(watermarks, f, indent = 2, sort_keys = True)
 
 
-def validate_data(start_date, end_date, typ, frmt, data):
-  print ('VALIDATING DATA: ' + frmt + '\t' + typ)
+def player_filename(country, name):
+  return country + '_' + name + '.data'
 
-  date_to_count = {}
-  for p in data:
-    for d in data[p]['ratings']:
-      if d not in date_to_count:
-        date_to_count[d] = 0
-      date_to_count[d] += 1
-  print ('Dates built back: ' + str(len(date_to_count)))
+def get_stage_dir(typ, frmt):
+  return Path('players' + SUFFIX + '/.build/' + typ + '/' + frmt)
 
-  mismatch = False
-  d = start_date
-  while (d < end_date):
-    (yr, mn, dy) = date_to_parts(d)
-    date_str = yr + mn + dy
-    filename = 'data' + SUFFIX + '/' + typ + '/' + frmt + '/' + date_str + '.csv'
-    lines = get_file_lines(filename)
+def clear_stage_dir(typ, frmt):
+  stage_dir = get_stage_dir(typ, frmt)
+  if stage_dir.exists():
+    shutil.rmtree(stage_dir)
 
-    failed = False
-    if not lines:
-      d += ONE_DAY
-      continue
-    if date_str not in date_to_count:
-      mismatch = True
-      print (date_str + ':\t' + 'NO PLAYER DATA FOUND')
-      d += ONE_DAY
-      continue
+def flush_player_rows(stage_dir, player_rows):
+  stage_dir.mkdir(exist_ok = True, parents = True)
+  for filename, rows in player_rows.items():
+    with (stage_dir / filename).open('a') as f:
+      f.writelines(rows)
+  player_rows.clear()
+
+
+def get_data_filename(date_str, typ, frmt):
+  return 'data' + SUFFIX + '/' + typ + '/' + frmt + '/' + date_str + '.csv'
+
+
+def read_same_as(typ, frmt):
+  # Days stored by get_data.py as having the same rows as an earlier day's CSV
+  same_as = {}
+  same_as_file = Path('data' + SUFFIX + '/' + typ + '/' + frmt + '/same_as.csv')
+  if same_as_file.exists():
+    with same_as_file.open('r') as f:
+      for l in f:
+        if l.strip():
+          date_str, source_date_str = l.strip().split(',')
+          same_as[date_str] = source_date_str
+  return same_as
+
+
+def get_source_date(date_str, typ, frmt, same_as):
+  # A loose CSV takes precedence over same_as, which takes precedence over a packed CSV
+  if date_str in same_as and not Path(get_data_filename(date_str, typ, frmt)).exists():
+    return same_as[date_str]
+  return date_str
+
+
+def open_year_archive(yr, typ, frmt, archives):
+  # data/<type>/<format>/<year>.zip written by pack_data.py, kept open while parsing
+  if yr not in archives:
+    archive_file = Path('data' + SUFFIX + '/' + typ + '/' + frmt + '/' + yr + '.zip')
+    archive = ZipFile(archive_file) if archive_file.exists() else None
+    archives[yr] = (archive, set(archive.namelist()) if archive else set())
+  return archives[yr]
+
+
+def get_day_lines(date_str, typ, frmt, archives):
+  filename = get_data_filename(date_str, typ, frmt)
+  if not Path(filename).exists():
+    archive, members = open_year_archive(date_str[ : 4], typ, frmt, archives)
+    if date_str + '.csv' in members:
+      with io.TextIOWrapper(archive.open(date_str + '.csv')) as f:
+        return f.readlines()
+  return get_file_lines(filename)
+
+
+def parse_date(date_str, typ, frmt, archives):
+  lines = get_day_lines(date_str, typ, frmt, archives)
+
+  day_data = {}
+  if not lines:
+    return 0, day_data
+
+  ranks, ratings, names, countries = read_day_lines(lines)
+  for rank, rating, name, country in zip(ranks.tolist(), ratings.tolist(), names, countries):
+    name = '_'.join(fix_name(part) for part in name.split(','))
+    key = country + ' ' + name
+    day_data[key] = (player_filename(country, name), rank, rating)
 
-    original_count = len(lines)
-    parsed_count = date_to_count[date_str]
+  return len(lines), day_data
+
+
+def report_validation(typ, frmt, date_counts):
+  print ('VALIDATING DATA: ' + frmt + '\t' + typ)
+  print ('Dates built back: ' + str(len(date_counts)))
+
+  mismatch = False
+  for date_str, (original_count, parsed_count) in date_counts.items():
     if not parsed_count == original_count:
       mismatch = True
       print (date_str + ':\t' + 'ORIGINAL: ' + str(original_count) + ',\t' \
               + 'PARSED: ' + str(parsed_count))
 
-    d += ONE_DAY
-
   return not mismatch
 
 
 def parse_all_dates(typ, frmt, start_date, end_date):
-  player_data = {}
+  # Reads each daily file once, staging player rows on disk in batches of FLUSH_ROWS
+  clear_stage_dir(typ, frmt)
+  stage_dir = get_stage_dir(typ, frmt)
+
+  player_files = set()
+  player_rows = {}
+  buffered_rows = 0
+  date_counts = {}
+
+  same_as = read_same_as(typ, frmt)
+  # Days in same_as reuse the parse of the day whose CSV holds their rows
+  last_parsed = ('', (0, {}))
+  archives = {}
+
   d = start_date
   while (d < end_date):
-    parse_date(d, typ, frmt, player_data)
+    (yr, mn, dy) = date_to_parts(d)
+    date_str = yr + mn + dy
+    source_date_str = get_source_date(date_str, typ, frmt, same_as)
+    if not last_parsed[0] == source_date_str:
+      last_parsed = (source_date_str, parse_date(source_date_str, typ, frmt, archives))
+    original_count, day_data = last_parsed[1]
+    if original_count:
+      date_counts[date_str] = (original_count, len(day_data))
+
+    for filename, rank, rating in day_data.values():
+      player_files.add(filename)
+      if filename not in player_rows:
+        player_rows[filename] = []
+      player_rows[filename].append(date_str + ',' + str(rank) + ',' + str(rating) + '\n')
+    buffered_rows += len(day_data)
+
+    if buffered_rows >= FLUSH_ROWS:
+      flush_player_rows(stage_dir, player_rows)
+      buffered_rows = 0
     d += ONE_DAY
+  flush_player_rows(stage_dir, player_rows)
+  for archive, _ in archives.values():
+    if archive:
+      archive.close()
 
   if not VALIDATION or frmt == 'test' and SKIP_VALIDATION_FOR_TESTS:
     print (typ + ': VALIDATION SKIPPED')
-    return player_data
-  
-  if validate_data(start_date, end_date, typ, frmt, player_data):
+    return player_files
+
+  if report_validation(typ, frmt, date_counts):
     print (typ + ': VALIDATION SUCCESS')
-    return player_data
+    return player_files
   else:
     print (typ + ': VALIDATION FAILED')
-    return {}
+    clear_stage_dir(typ, frmt)
+    return None
+
+
+def read_player_table(filename):
+  # One row of YYYYMMDD date, rank and rating per line, in date order
+  return np.stack(read_player_file(filename), axis = 1)
+
+def read_player_ratings(filename):
+  dates, _, ratings = read_player_file(filename)
+  return dates, ratings
+
 
+def build_allrounder_data(player_files_by_type, frmt, start_date, end_date):
+  clear_stage_dir('allrounder', frmt)
+  stage_dir = get_stage_dir('allrounder', frmt)
+  batting_dir = get_stage_dir('batting', frmt)
+  bowling_dir = get_stage_dir('bowling', frmt)
 
-def build_allrounder_data(player_data_by_format, start_date, end_date):
-  max_ever = 0
-  batting_player_data = player_data_by_format['batting']
-  bowling_player_data = player_data_by_format['bowling']
-  all_player_data = {}
-  for key in batting_player_data:
-    if key not in bowling_player_data:
+  all_player_files = set()
+  if player_files_by_type['batting'] is None or player_files_by_type['bowling'] is None:
+    return None
+
+  for filename in player_files_by_type['batting']:
+    if filename not in player_files_by_type['bowling']:
+      continue
+    batting_dates, batting_ratings = read_player_ratings(str(batting_dir / filename))
+    bowling_dates, bowling_ratings = read_player_ratings(str(bowling_dir / filename))
+
+    # Join on dates rated in both, within [start_date, end_date)
+    dates, batting_idx, bowling_idx = np.intersect1d(batting_dates, bowling_dates, \
+                                                      assume_unique = True, \
+                                                      return_indices = True)
+    in_range = (dates >= int(''.join(date_to_parts(start_date)))) \
+                & (dates < int(''.join(date_to_parts(end_date))))
+    ratings = np.sqrt(batting_ratings[batting_idx[in_range]] \
+                        * bowling_ratings[bowling_idx[in_range]]).astype(np.int64)
+
+    player_rows = [str(d) + ',0,' + str(r) + '\n' \
+                    for d, r in zip(dates[in_range].tolist(), ratings.tolist())]
+
+    if player_rows:
+      flush_player_rows(stage_dir, {filename: player_rows})
+      all_player_files.add(filename)
+
+  return all_player_files
+
+
+def get_archive_file(typ, frmt):
+  return Path('players' + SUFFIX + '/' + typ + '/' + frmt + '.npz')
+
+def get_player_dir(typ, frmt):
+  return Path('players' + SUFFIX + '/' + typ + '/' + frmt)
+
+def read_player_archive_tables(archive_file):
+  return {p: np.stack([dates, ranks, ratings], axis = 1).astype(np.int64) \
+            for p, dates, ranks, ratings in read_player_archive(archive_file)}
+
+def read_player_dir_tables(player_dir):
+  return {f.name: read_player_table(str(f)) for f in player_dir.iterdir() if f.is_file()}
+
+def write_player_archive(typ, frmt, player_files, watermark = ''):
+  # Merges staged player files into the archive, replacing it unless there is a
+  # watermark, in which case staged rows on or after the watermark are appended.
+  # The layout is read back by common.readers.read_player_archive.
+  stage_dir = get_stage_dir(typ, frmt)
+  archive_file = get_archive_file(typ, frmt)
+  player_dir = get_player_dir(typ, frmt)
+
+  tables = {}
+  if watermark and archive_file.exists():
+    tables = read_player_archive_tables(archive_file)
+  elif watermark and player_dir.exists():
+    # Earlier rows were built in file mode
+    tables = read_player_dir_tables(player_dir)
+  for filename in player_files:
+    table = read_player_table(str(stage_dir / filename))
+    if watermark:
+      table = table[table[:, 0] >= int(watermark)]
+    if filename in tables:
+      table = np.concatenate([tables[filename], table])
+    tables[filename] = table
+  clear_stage_dir(typ, frmt)
+
+  if not tables:
+    return
+  players = sorted(tables)
+  offsets = np.cumsum([0] + [len(tables[p]) for p in players])
+  table = np.concatenate([tables[p] for p in players])
+
+  archive_file.parent.mkdir(exist_ok = True, parents = True)
+  temp_file = archive_file.with_suffix('.tmp.npz')
+  np.savez_compressed(temp_file, players = np.array(players), offsets = offsets, \
+                      dates = table[:, 0].astype(np.int32), \
+                      ranks = table[:, 1].astype(np.int16), \
+                      ratings = table[:, 2].astype(np.int16))
+  replace(temp_file, archive_file)
+
+  # Player files from an earlier build would be read stale by utils that need file mode
+  if player_dir.exists():
+    shutil.rmtree(player_dir)
+
+
+def write_player_files(typ, frmt, player_files, watermark = ''):
+  # Moves staged player files over any previous build, or with a watermark,
+  # appends staged rows on or after the watermark to existing player files
+  stage_dir = get_stage_dir(typ, frmt)
+  output_dir = get_player_dir(typ, frmt)
+  archive_file = get_archive_file(typ, frmt)
+  if player_files:
+    output_dir.mkdir(exist_ok = True, parents = True)
+
+  if watermark and archive_file.exists():
+    # Earlier rows were built in archive mode
+    output_dir.mkdir(exist_ok = True, parents = True)
+    for p, table in read_player_archive_tables(archive_file).items():
+      with (output_dir / p).open('w') as f:
+        f.writelines([','.join(map(str, row)) + '\n' for row in table.tolist()])
+
+  for filename in player_files:
+    if not watermark:
+      replace(stage_dir / filename, output_dir / filename)
       continue
-    all_player_data[key] = {}
-    all_player_data[key]['country'] = batting_player_data[key]['country']
-    all_player_data[key]['name'] = batting_player_data[key]['name']
-    all_player_data[key]['ratings'] = {}
-    d = start_date
-    while d < end_date:
-      (yr, mn, dy) = date_to_parts(d)
-      date_str = yr + mn + dy
-      if date_str in batting_player_data[key]['ratings'] \
-          and date_str in bowling_player_data[key]['ratings']:
-        batting_rating = batting_player_data[key]['ratings'][date_str]['rating']
-        bowling_rating = bowling_player_data[key]['ratings'][date_str]['rating']
-        all_player_data[key]['ratings'][date_str] = {}
-        all_player_data[key]['ratings'][date_str]['rank'] = 0
-        rating = int(math.sqrt(batting_rating * bowling_rating))
-        if rating > max_ever:
-          max_ever = rating
-        all_player_data[key]['ratings'][date_str]['rating'] = rating
-      d += ONE_DAY
-
-    if len(all_player_data[key]['ratings']) == 0:
-      del all_player_data[key]
-
-  return all_player_data
+    rows = [l for l in get_file_lines(str(stage_dir / filename)) if l[ : 8] >= watermark]
+    with (output_dir / filename).open('a') as f:
+      f.writelines(rows)
+  clear_stage_dir(typ, frmt)
+
+  # An archive from an earlier build would shadow these files in get_daily_ratings
+  if archive_file.exists():
+    archive_file.unlink()
+
+
+def get_parse_start_date(frmt, start_date, watermarks):
+  if not INCREMENTAL:
+    return start_date
+  if not all(typ + '_' + frmt in watermarks for typ in TYPE):
+    print ('No previous build for all types, building ' + frmt + ' from ' + str(start_date))
+    return start_date
+
+  # Days from the oldest watermark onwards, rows before newer watermarks are dropped on write
+  watermark = min(watermarks[typ + '_' + frmt] for typ in TYPE)
+  return max(start_date, string_to_date(watermark))
 
-for frmt, start_date in START_DATES.items():
-  print ('\n== ' + frmt + ' ==\n')
 
-  player_data_by_format = {}
-  for typ in ['batting', 'bowling']:
-    if typ in TYPE or 'allrounder' in TYPE:
-      player_data_by_format[typ] = parse_all_dates(typ, frmt, start_date, end_date = END_DATE)
+def get_executor():
+  num_workers = NUM_WORKERS or cpu_count() or 1
+  # This script runs at import time, so workers must be forked rather than spawned
+  if num_workers > 1 and 'fork' in get_all_start_methods():
+    return ProcessPoolExecutor(max_workers = num_workers, mp_context = get_context('fork'))
+  return ThreadPoolExecutor(max_workers = 1)
+
+
+def write_format(frmt, player_files_by_type, incremental, watermarks):
+  print ('\n== ' + frmt + ' ==\n')
 
   for typ in TYPE:
     print ('\n' + frmt + '\t' + typ)
+    if player_files_by_type[typ] is None:
+      print (frmt + ' ' + typ + ' data not written')
+      continue
+    print ('Players built: ' + '\t' + str(len(player_files_by_type[typ])))
 
-    if typ == 'allrounder':
-      all_player_data = build_allrounder_data(player_data_by_format, start_date,
-                                              end_date = END_DATE)
+    watermark = watermarks[typ + '_' + frmt] if incremental else ''
+    if ARCHIVE:
+      write_player_archive(typ, frmt, player_files_by_type[typ], watermark = watermark)
     else:
-      all_player_data = player_data_by_format[typ]
-
-    print ('Players built: ' + '\t' + str(len(all_player_data)))
+      write_player_files(typ, frmt, player_files_by_type[typ], watermark = watermark)
+    if not incremental or END_DATE > string_to_date(watermark):
+      write_watermark(typ, frmt, END_DATE)
+    print(frmt + ' ' + typ + ' data written')
 
-    for key in all_player_data:
-      country = all_player_data[key]['country']
-      name = all_player_data[key]['name']
-      ratings = all_player_data[key]['ratings']
-      filename = 'players' + SUFFIX + '/' + typ + '/' + frmt + '/' + country + '_' + name + '.data'
+  for typ in player_files_by_type:
+    clear_stage_dir(typ, frmt)
 
-      output_file = Path(filename)
-      output_file.parent.mkdir(exist_ok = True, parents = True)
 
-      with output_file.open('w') as f:
-        for date_str in ratings:
-          f.write(date_str + ',' \
-                  + str(all_player_data[key]['ratings'][date_str]['rank']) + ',' \
-                  + str(all_player_data[key]['ratings'][date_str]['rating']) + '\n')
-    print(frmt + ' ' + typ + ' data written')
+watermarks = read_watermarks() if INCREMENTAL else {}
 
+parse_start_dates = {}
+for frmt, start_date in START_DATES.items():
+  parse_start_dates[frmt] = get_parse_start_date(frmt, start_date, watermarks)
+  if parse_start_dates[frmt] > start_date:
+    print ('Incremental build for ' + frmt + ' from ' + str(parse_start_dates[frmt]))
+
+parse_types = {typ for typ in ['batting', 'bowling'] if typ in TYPE or 'allrounder' in TYPE}
+player_files_by_format = {frmt: {} for frmt in START_DATES}
+
+# Parse tasks for every format and type run concurrently. Each format's allrounder join
+# starts once its batting and bowling are staged, and the format is written after that.
+with get_executor() as executor:
+  tasks = {}
+  for frmt in START_DATES:
+    for typ in parse_types:
+      tasks[executor.submit(parse_all_dates, typ, frmt, parse_start_dates[frmt], \
+                            END_DATE)] = (typ, frmt)
+
+  while tasks:
+    done, _ = wait(tasks, return_when = FIRST_COMPLETED)
+    for task in done:
+      typ, frmt = tasks.pop(task)
+      player_files_by_type = player_files_by_format[frmt]
+      player_files_by_type[typ] = task.result()
+
+      if typ in parse_types and 'allrounder' in TYPE \
+          and parse_types <= player_files_by_type.keys():
+        tasks[executor.submit(build_allrounder_data, player_files_by_type, frmt, \
+                              parse_start_dates[frmt], END_DATE)] = ('allrounder', frmt)
+      elif (TYPE | parse_types) <= player_files_by_type.keys():
+        write_format(frmt, player_files_by_type, \
+                      incremental = parse_start_dates[frmt] > START_DATES[frmt], \
+                      watermarks = watermarks)
+
+shutil.rmtree(Path('players' + SUFFIX + '/.build'), ignore_errors = True)
 print ('\nAll data written')
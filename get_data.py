@@ -1,6 +1,18 @@
-from urllib import request
-from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
+from functools import lru_cache
+from http.client import HTTPConnection, HTTPSConnection, HTTPException, RemoteDisconnected
+from os import replace
+from pathlib import Path
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+from zipfile import ZipFile
+
+import asyncio
+import io
+import json
+import random
 
 # ['batting', 'bowling']
 TYPE = {'batting', 'bowling'}
@@ -14,9 +26,42 @@ ONE_DAY = timedelta(days = 1)
 STOP_ON_ERROR = True
 SUFFIX = ''
 
+# Skip pages recorded as done in data/crawl_manifest.csv by earlier runs
+RESUME = True
+# Skip pages whose CSV already exists and is not empty, or is packed into a year archive
+SKIP_EXISTING = False
+
+# Store days with the same rows as the previous day in data/<type>/<format>/same_as.csv
+# instead of writing a CSV for them
+SKIP_UNCHANGED_DAYS = True
+# Instead of crawling, move existing CSVs that match the previous day into same_as.csv
+DEDUPE_EXISTING = False
+
+# Point at a local stand-in server for testing
+BASE_URL = 'https://iccbackup.co.uk/datespecific/'
+# Persistent keep-alive connections, each serving one page request at a time
+MAX_CONNECTIONS = 8
+REQUEST_TIMEOUT = 30
+
+# Attempts per page, with exponential backoff from BACKOFF_BASE up to BACKOFF_MAX seconds
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# Pages slower than this (seconds) count against the concurrency limit
+LATENCY_TARGET = 5
+
+# Seconds between throughput and latency reports. A summary of the whole crawl is
+# written to data/crawl_metrics.json.
+METRICS_INTERVAL = 30
+
 assert not set(TYPE) - {'batting', 'bowling', 'allrounder'}, "Invalid TYPE provided"
 assert not set(FORMAT) - {'test', 'odi', 't20'}, "Invalid FORMAT provided"
 assert START_DATE < TODAY, "START_DATE must be in the past"
+assert urlsplit(BASE_URL).scheme in ['http', 'https'], "BASE_URL must be http or https"
+assert MAX_CONNECTIONS >= 1, "MAX_CONNECTIONS must be at least 1"
+assert MAX_ATTEMPTS >= 1, "MAX_ATTEMPTS must be at least 1"
+assert 0 <= BACKOFF_BASE <= BACKOFF_MAX, "BACKOFF_BASE must be between 0 and BACKOFF_MAX"
+assert METRICS_INTERVAL > 0, "METRICS_INTERVAL must be positive"
 
 REQUEST_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/120.0.0.0'}
 
@@ -49,66 +94,146 @@ def date_to_parts(d):
   return (yr, mn, dy)
 
 
-def get_data(d, frmt, typ):
+def open_connection():
+  url = urlsplit(BASE_URL)
+  if url.scheme == 'https':
+    return HTTPSConnection(url.netloc, timeout = REQUEST_TIMEOUT)
+  return HTTPConnection(url.netloc, timeout = REQUEST_TIMEOUT)
+
+
+# Raised when a server has closed an idle keep-alive connection before a request on it
+STALE_CONNECTION_ERRORS = (RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+def send_request(connection, path, metrics):
+  if connection.sock is None:
+    # DNS lookup, TCP and TLS handshakes for a new or reopened connection
+    start_time = monotonic()
+    connection.connect()
+    metrics['connect'] += monotonic() - start_time
+
+  start_time = monotonic()
+  connection.request('GET', path, headers = REQUEST_HEADERS)
+  response = connection.getresponse()
+  metrics['download'] += monotonic() - start_time
+  return response
+
+
+def get_data(connection, d, frmt, typ, metrics):
   (yr, mn, dy) = date_to_parts(d)
-  url = 'https://iccbackup.co.uk/datespecific/' + frmt + '/' \
+  path = urlsplit(BASE_URL).path + frmt + '/' \
         + typ  + '/' + yr + '/' + mn + '/' + dy + '/'
 
-  text = ''
-  while not text:
+  # Returns page text, or empty text and the last error once all attempts fail.
+  # Time spent connecting, downloading and backing off is added to metrics.
+  error = ''
+  for attempt in range(MAX_ATTEMPTS):
+    if attempt > 0:
+      # Full jitter: a random wait of up to the exponential backoff for this attempt
+      backoff = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+      sleep(backoff)
+      metrics['backoff'] += backoff
+    metrics['attempts'] = attempt + 1
     try:
-      req = request.Request(url, headers = REQUEST_HEADERS)
-      page = request.urlopen(req)
-      text = page.read().decode('utf-8')
-    except:
-      print (yr + '\t' + mn + '\t' + dy + '\t' + 'Retrying')
-  
-  return text
+      reused = connection.sock is not None
+      try:
+        response = send_request(connection, path, metrics)
+      except STALE_CONNECTION_ERRORS:
+        if not reused:
+          raise
+        # The server dropped the idle connection before answering: resend once on a new
+        # one, without counting an attempt or backing off
+        connection.close()
+        response = send_request(connection, path, metrics)
+
+      start_time = monotonic()
+      body = response.read()
+      metrics['download'] += monotonic() - start_time
+      metrics['bytes'] += len(body)
+      if not response.status == 200:
+        raise HTTPException('HTTP ' + str(response.status))
+      text = body.decode('utf-8')
+      if not text:
+        raise HTTPException('Empty page')
+      return text, '', attempt + 1
+    except Exception as e:
+      # The connection is reopened by the next request
+      connection.close()
+      error = type(e).__name__ + ': ' + str(e)
+      print (yr + '\t' + mn + '\t' + dy + '\t' + frmt + '\t' + typ + '\t' + 'Retrying')
+
+  return '', error, MAX_ATTEMPTS
 
 
 def parse_html(h):
+  # Single pass over the page with absolute offsets. A row with a missing tag ends
+  # the parse, keeping the rows before it.
   data = []
   pos = h.find(ID_TAG_PREFIX)
   while (pos != -1):
-    pos = h.find(ID_TAG_PREFIX)
-    h = h[pos : ]
-    start_pos = h.find(ID_TAG_START) + 1
-    end_pos = h.find(ID_TAG_END)
-    rank = eval(h[start_pos : end_pos].strip())
-    h = h[end_pos : ]
-
-    pos = h.find(RATING_TAG_PREFIX)
-    h = h[pos : ]
-    start_pos = h.find(RATING_TAG_START) + 1
-    end_pos = h.find(RATING_TAG_END)
-    rating = eval(h[start_pos : end_pos].strip())
-    h = h[end_pos : ]
-
-    pos = h.find(NAME_TAG_PREFIX)
-    h = h[pos : ]
-    start_pos = h.find(NAME_TAG_START) + 1
-    end_pos = h.find(NAME_TAG_END)
-    name = h[start_pos : end_pos].strip()
-
-    pos = h.find(NATION_TAG_PREFIX)
-    h = h[pos : ]
-    start_pos = h.find(NATION_TAG_START) + 1
-    end_pos = h.find(NATION_TAG_END)
-    nation = h[start_pos : end_pos].strip()
-
-    pos = h.find(BURN_PREFIX)
-    h = h[pos + len(BURN_PREFIX) : ]
+    rank_start = h.find(ID_TAG_START, pos)
+    rank_end = h.find(ID_TAG_END, pos)
+
+    rating_pos = h.find(RATING_TAG_PREFIX, rank_end)
+    rating_start = h.find(RATING_TAG_START, rating_pos)
+    rating_end = h.find(RATING_TAG_END, rating_pos)
+
+    name_pos = h.find(NAME_TAG_PREFIX, rating_end)
+    name_start = h.find(NAME_TAG_START, name_pos)
+    name_end = h.find(NAME_TAG_END, name_pos)
+
+    nation_pos = h.find(NATION_TAG_PREFIX, name_pos)
+    nation_start = h.find(NATION_TAG_START, nation_pos)
+    nation_end = h.find(NATION_TAG_END, nation_pos)
+
+    burn_pos = h.find(BURN_PREFIX, nation_pos)
+    if -1 in (rank_start, rank_end, rating_pos, rating_start, rating_end, \
+              name_pos, name_start, name_end, nation_pos, nation_start, nation_end, burn_pos):
+      print ('\tPARSE STOPPED: missing tag after ' + str(len(data)) + ' rows')
+      return data
+
+    rank = int(h[rank_start + 1 : rank_end].strip())
+    rating = int(h[rating_start + 1 : rating_end].strip())
+    name = h[name_start + 1 : name_end].strip()
+    nation = h[nation_start + 1 : nation_end].strip()
 
     player_text = str(rank) + ',' + str(rating) + ',' + name + ',' + nation
     data.append(player_text + '\n')
 
-    pos = h.find(ID_TAG_PREFIX)
+    pos = h.find(ID_TAG_PREFIX, burn_pos + len(BURN_PREFIX))
   return data
 
 
-def write_data(d, frmt, typ, data):
+def date_to_string(d):
   (yr, mn, dy) = date_to_parts(d)
-  filename = 'data' + SUFFIX + '/' + typ + '/' + frmt + '/' + yr + mn + dy + '.csv'
+  return yr + mn + dy
+
+
+def get_data_filename(date_str, frmt, typ):
+  return 'data' + SUFFIX + '/' + typ + '/' + frmt + '/' + date_str + '.csv'
+
+
+def get_year_archive_file(yr, frmt, typ):
+  return Path('data' + SUFFIX + '/' + typ + '/' + frmt + '/' + yr + '.zip')
+
+
+@lru_cache(maxsize = None)
+def get_packed_days(yr, frmt, typ):
+  # Days packed into data/<type>/<format>/<year>.zip by pack_data.py
+  archive_file = get_year_archive_file(yr, frmt, typ)
+  if not archive_file.exists():
+    return frozenset()
+  with ZipFile(archive_file) as archive:
+    return frozenset(name[ : -len('.csv')] for name in archive.namelist())
+
+
+def read_packed_day(date_str, frmt, typ):
+  with ZipFile(get_year_archive_file(date_str[ : 4], frmt, typ)) as archive:
+    with io.TextIOWrapper(archive.open(date_str + '.csv')) as f:
+      return f.readlines()
+
+
+def write_data(d, frmt, typ, data):
+  filename = get_data_filename(date_to_string(d), frmt, typ)
 
   output_file = Path(filename)
   output_file.parent.mkdir(exist_ok = True, parents = True)
@@ -119,37 +244,423 @@ def write_data(d, frmt, typ, data):
   print('\t' + filename + '\t' + str(len(data)))
 
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-def process_data(d, frmt, typ):
-  text = get_data(d, frmt, typ)
+def get_same_as_file(frmt, typ):
+  return Path('data' + SUFFIX + '/' + typ + '/' + frmt + '/same_as.csv')
+
+
+def read_same_as(frmt, typ):
+  # YYYYMMDD,YYYYMMDD lines mapping a day to the earlier day whose CSV has its rows
+  same_as = {}
+  same_as_file = get_same_as_file(frmt, typ)
+  if same_as_file.exists():
+    with same_as_file.open('r') as f:
+      for l in f:
+        if l.strip():
+          date_str, source_date_str = l.strip().split(',')
+          same_as[date_str] = source_date_str
+  return same_as
+
+
+def write_same_as(frmt, typ, same_as):
+  same_as_file = get_same_as_file(frmt, typ)
+  tmp_file = same_as_file.with_suffix('.csv.tmp')
+  with tmp_file.open('w') as f:
+    for date_str in sorted(same_as):
+      f.write(date_str + ',' + same_as[date_str] + '\n')
+  replace(tmp_file, same_as_file)
+
+
+def record_same_as(d, frmt, typ, source_date_str, same_as):
+  date_str = date_to_string(d)
+  same_as_file = get_same_as_file(frmt, typ)
+  same_as_file.parent.mkdir(exist_ok = True, parents = True)
+
+  # Days whose rows were read from this day's CSV now read them from its source
+  referrers = [k for k, v in same_as.items() if v == date_str]
+  for k in referrers:
+    same_as[k] = source_date_str
+  same_as[date_str] = source_date_str
+  if referrers:
+    write_same_as(frmt, typ, same_as)
+  else:
+    with same_as_file.open('a') as f:
+      f.write(date_str + ',' + source_date_str + '\n')
+
+  # A CSV left by an earlier crawl would take precedence over the index
+  data_file = Path(get_data_filename(date_str, frmt, typ))
+  if data_file.exists():
+    data_file.unlink()
+  print('\t' + str(same_as_file) + '\t' + date_str + ' same as ' + source_date_str)
+
+
+def read_stored_day(d, frmt, typ, same_as):
+  # Rows stored for a day and the date of the CSV holding them, or None if not stored.
+  # A loose CSV takes precedence over same_as, which takes precedence over a packed CSV.
+  date_str = date_to_string(d)
+  data_file = Path(get_data_filename(date_str, frmt, typ))
+  if not data_file.exists() and date_str in same_as:
+    date_str = same_as[date_str]
+    data_file = Path(get_data_filename(date_str, frmt, typ))
+
+  if data_file.exists():
+    with data_file.open('r') as f:
+      return f.readlines(), date_str
+  if date_str in get_packed_days(date_str[ : 4], frmt, typ):
+    return read_packed_day(date_str, frmt, typ), date_str
+  return None, ''
+
+
+class DayCommitter:
+  # Stores the pages of one format and type in date order, so that each day can be
+  # compared with the previous one before it is written
+  def __init__(self, frmt, typ, on_commit):
+    self.frmt = frmt
+    self.typ = typ
+    self.on_commit = on_commit
+    self.same_as = read_same_as(frmt, typ)
+
+    self.queued_days = deque()
+    self.results = {}
+    # Last committed day, its rows and the date of the CSV holding them
+    self.last_day = (None, None, '')
+
+  def queue(self, d):
+    self.queued_days.append(d)
+
+  def page_done(self, d, players):
+    # players is None for a failed page
+    self.results[d] = players
+    while self.queued_days and self.queued_days[0] in self.results:
+      d = self.queued_days.popleft()
+      self.commit(d, self.results.pop(d))
+
+  def commit(self, d, players):
+    if players is None:
+      self.last_day = (None, None, '')
+      return
+
+    start_time = monotonic()
+    prev_d = d - ONE_DAY
+    if self.last_day[0] == prev_d:
+      _, prev_players, prev_date_str = self.last_day
+    else:
+      prev_players, prev_date_str = read_stored_day(prev_d, self.frmt, self.typ, self.same_as)
+
+    if SKIP_UNCHANGED_DAYS and players == prev_players:
+      record_same_as(d, self.frmt, self.typ, prev_date_str, self.same_as)
+      date_str = prev_date_str
+    else:
+      write_data(d, self.frmt, self.typ, players)
+      date_str = date_to_string(d)
+
+    self.last_day = (d, players, date_str)
+    self.on_commit(d, self.frmt, self.typ, monotonic() - start_time)
+
+
+def dedupe_existing(start_date, end_date):
+  for frmt in FORMAT:
+    for typ in TYPE:
+      same_as = read_same_as(frmt, typ)
+      prev_players, prev_date_str = read_stored_day(start_date - ONE_DAY, frmt, typ, same_as)
+
+      num_deduped = 0
+      d = start_date
+      while d < end_date:
+        players, date_str = read_stored_day(d, frmt, typ, same_as)
+        if players and date_str == date_to_string(d) and players == prev_players:
+          record_same_as(d, frmt, typ, prev_date_str, same_as)
+          date_str = prev_date_str
+          num_deduped += 1
+        prev_players, prev_date_str = players, date_str
+        d += ONE_DAY
+
+      print (frmt + '\t' + typ + '\t' + 'Days same as previous day: ' + str(num_deduped))
+
+
+def get_manifest_file():
+  return Path('data' + SUFFIX + '/crawl_manifest.csv')
+
+
+def read_manifest():
+  # One YYYYMMDD,format,type line per page written
+  manifest_file = get_manifest_file()
+  if not manifest_file.exists():
+    return set()
+  with manifest_file.open('r') as f:
+    return {tuple(l.strip().split(',')) for l in f if l.strip()}
+
+
+def is_page_done(d, frmt, typ, done_pages, same_as):
+  date_str = date_to_string(d)
+  if RESUME and (date_str, frmt, typ) in done_pages:
+    return True
+  if SKIP_EXISTING:
+    data_file = Path(get_data_filename(date_str, frmt, typ))
+    return date_str in same_as or date_str in get_packed_days(date_str[ : 4], frmt, typ) \
+              or data_file.exists() and data_file.stat().st_size > 0
+  return False
+
+
+def process_data(connection, d, frmt, typ):
+  # Timings in seconds for one page, from first request to parsed rows
+  metrics = {'attempts': 0, 'connect': 0, 'download': 0, 'backoff': 0, 'parse': 0, \
+              'latency': 0, 'bytes': 0, 'rows': 0}
+  start_time = monotonic()
+  text, error, _ = get_data(connection, d, frmt, typ, metrics)
+
+  if error:
+    metrics['latency'] = monotonic() - start_time
+    print("\tFETCH FAILED for " + frmt + " " + typ + ": " + error)
+    return error, None, metrics
+
+  parse_start_time = monotonic()
   players = parse_html(text)
-
+  metrics['parse'] = monotonic() - parse_start_time
+  metrics['latency'] = monotonic() - start_time
+  metrics['rows'] = len(players)
   if not players:
     print("\tNO PLAYERS FOUND for " + frmt + " " + typ)
-    return False
-
-  write_data(d, frmt, typ, players)
-  return True
-
-failure_days = []
-d = START_DATE
-while d < TODAY:
-  print(d)
-  tasks = []
-  with ThreadPoolExecutor() as executor:
-    for frmt in FORMAT:
-      for typ in TYPE:
-        tasks.append(executor.submit(process_data, d, frmt, typ))
-    success = [t.result() for t in as_completed(tasks)]
-    if not all(success):
+    return 'No players found', None, metrics
+
+  return '', players, metrics
+
+
+class ConcurrencyController:
+  # Additive-increase, multiplicative-decrease limit on pages fetched at once
+  def __init__(self, max_limit):
+    self.max_limit = max_limit
+    self.limit = max(1, max_limit // 2)
+    self.active = 0
+    self.healthy_pages = 0
+    self.condition = asyncio.Condition()
+
+  async def acquire(self):
+    async with self.condition:
+      await self.condition.wait_for(lambda: self.active < self.limit)
+      self.active += 1
+
+  async def release(self, healthy):
+    async with self.condition:
+      self.active -= 1
+      if not healthy:
+        self.limit = max(1, self.limit // 2)
+        self.healthy_pages = 0
+      else:
+        self.healthy_pages += 1
+        if self.healthy_pages >= self.limit and self.limit < self.max_limit:
+          self.limit += 1
+          self.healthy_pages = 0
+      self.condition.notify_all()
+
+
+def percentile(sorted_values, p):
+  # Nearest-rank percentile of an already sorted list
+  if not sorted_values:
+    return 0
+  return sorted_values[max(0, -(-len(sorted_values) * p // 100) - 1)]
+
+
+class CrawlMetrics:
+  # Per-page timings, with throughput and latency reported every METRICS_INTERVAL seconds
+  STAGES = ['connect', 'download', 'backoff', 'parse', 'write', 'latency']
+
+  def __init__(self):
+    self.start_time = monotonic()
+    self.timings = {stage: [] for stage in self.STAGES}
+    self.totals = {'pages': 0, 'failed_pages': 0, 'days': 0, \
+                    'bytes': 0, 'retries': 0, 'rows': 0}
+    self.intervals = []
+    self.interval_start = (self.start_time, 0, 0, 0)
+
+  def page_done(self, error, metrics):
+    self.totals['pages'] += 1
+    if error:
+      self.totals['failed_pages'] += 1
+    self.totals['bytes'] += metrics['bytes']
+    self.totals['retries'] += metrics['attempts'] - 1
+    self.totals['rows'] += metrics['rows']
+    for stage in self.STAGES:
+      if stage in metrics:
+        self.timings[stage].append(metrics[stage])
+
+  def write_done(self, write_time):
+    self.timings['write'].append(write_time)
+
+  def day_done(self):
+    self.totals['days'] += 1
+    if monotonic() - self.interval_start[0] >= METRICS_INTERVAL:
+      self.report()
+
+  def report(self):
+    # Rates and latencies of pages finished since the last report
+    now = monotonic()
+    start_time, start_pages, start_days, start_bytes = self.interval_start
+    if self.totals['pages'] == start_pages:
+      return
+    elapsed = now - start_time
+    latencies = sorted(self.timings['latency'][start_pages : ])
+    interval = {'elapsed': round(now - self.start_time, 1), \
+                'pages_per_second': round((self.totals['pages'] - start_pages) / elapsed, 2), \
+                'days_per_second': round((self.totals['days'] - start_days) / elapsed, 2), \
+                'bytes_per_second': round((self.totals['bytes'] - start_bytes) / elapsed), \
+                'latency_p50': round(percentile(latencies, 50), 3), \
+                'latency_p95': round(percentile(latencies, 95), 3), \
+                'latency_p99': round(percentile(latencies, 99), 3)}
+    self.intervals.append(interval)
+    self.interval_start = (now, self.totals['pages'], self.totals['days'], \
+                            self.totals['bytes'])
+
+    print ('METRICS\t' + 'pages/s: ' + str(interval['pages_per_second']) + '\t' \
+            + 'days/s: ' + str(interval['days_per_second']) + '\t' \
+            + 'KB/s: ' + str(interval['bytes_per_second'] // 1000) + '\t' \
+            + 'latency p50/p95/p99: ' + str(interval['latency_p50']) + '/' \
+            + str(interval['latency_p95']) + '/' + str(interval['latency_p99']) + '\t' \
+            + 'retries: ' + str(self.totals['retries']))
+
+  def summary(self):
+    # Totals for the whole crawl and where page time went, stage by stage
+    elapsed = max(monotonic() - self.start_time, 0.001)
+    stages = {}
+    for stage, values in self.timings.items():
+      values = sorted(values)
+      stages[stage] = {'total': round(sum(values), 3), \
+                        'p50': round(percentile(values, 50), 4), \
+                        'p95': round(percentile(values, 95), 4), \
+                        'p99': round(percentile(values, 99), 4), \
+                        'max': round(values[-1], 4) if values else 0}
+
+    summary = dict(self.totals)
+    summary['elapsed'] = round(elapsed, 1)
+    summary['pages_per_second'] = round(self.totals['pages'] / elapsed, 2)
+    summary['days_per_second'] = round(self.totals['days'] / elapsed, 2)
+    summary['stages'] = stages
+    summary['intervals'] = self.intervals
+    return summary
+
+
+async def crawl_worker(executor, jobs, controller, on_page_done, on_page_skipped, stop):
+  # Each worker keeps one connection open across all the pages it fetches
+  loop = asyncio.get_running_loop()
+  connection = open_connection()
+  try:
+    while True:
+      job = await jobs.get()
+      if job is None:
+        return
+      d, frmt, typ = job
+      if stop.is_set():
+        on_page_skipped(d, frmt, typ)
+        continue
+
+      await controller.acquire()
+      try:
+        error, players, metrics = \
+              await loop.run_in_executor(executor, process_data, connection, d, frmt, typ)
+      except BaseException:
+        await controller.release(healthy = False)
+        raise
+      await controller.release(healthy = metrics['attempts'] == 1 \
+                                          and metrics['latency'] <= LATENCY_TARGET)
+      on_page_done(d, frmt, typ, error, players, metrics)
+  finally:
+    connection.close()
+
+
+async def crawl(start_date, end_date):
+  # Days are queued in order and fetched concurrently, up to MAX_CONNECTIONS pages at a time
+  done_pages = read_manifest()
+  pending_pages = {}
+  failed_days = set()
+  failures = []
+  stop = asyncio.Event()
+  controller = ConcurrencyController(MAX_CONNECTIONS)
+  metrics = CrawlMetrics()
+
+  manifest_file = get_manifest_file()
+  manifest_file.parent.mkdir(exist_ok = True, parents = True)
+  manifest = manifest_file.open('a')
+
+  def on_commit(d, frmt, typ, write_time):
+    # Flushed per page so that an interrupted crawl resumes from here
+    manifest.write(date_to_string(d) + ',' + frmt + ',' + typ + '\n')
+    manifest.flush()
+    metrics.write_done(write_time)
+
+  committers = {(frmt, typ): DayCommitter(frmt, typ, on_commit) \
+                  for frmt in FORMAT for typ in TYPE}
+
+  def on_page_skipped(d, frmt, typ):
+    committers[(frmt, typ)].page_done(d, None)
+
+  def on_page_done(d, frmt, typ, error, players, page_metrics):
+    committers[(frmt, typ)].page_done(d, players)
+    metrics.page_done(error, page_metrics)
+    if error:
+      failed_days.add(d)
+      failures.append({'date': str(d), 'format': frmt, 'type': typ, \
+                        'attempts': page_metrics['attempts'], 'error': error})
+    pending_pages[d] -= 1
+    if pending_pages[d] > 0:
+      return
+
+    del pending_pages[d]
+    print(d)
+    metrics.day_done()
+    if d in failed_days:
       if STOP_ON_ERROR:
         print("STOPPING ON ERROR")
-        break
-      failure_days.append(d)
-  d += ONE_DAY
-
-if failure_days:
-  print("DAYS WITH FAILURE: " + '\t' + str(len(failure_days)))
-  for d in failure_days:
-    print ('\t' + str(d))
+        stop.set()
+
+  jobs = asyncio.Queue(maxsize = 2 * MAX_CONNECTIONS)
+  with manifest, ThreadPoolExecutor(max_workers = MAX_CONNECTIONS) as executor:
+    workers = [asyncio.create_task(crawl_worker(executor, jobs, controller, on_page_done, \
+                                                on_page_skipped, stop)) \
+                for _ in range(MAX_CONNECTIONS)]
+
+    d = start_date
+    while d < end_date and not stop.is_set():
+      pages = [(d, frmt, typ) for frmt in FORMAT for typ in TYPE \
+                if not is_page_done(d, frmt, typ, done_pages, committers[(frmt, typ)].same_as)]
+      if pages:
+        pending_pages[d] = len(pages)
+      for page in pages:
+        committers[page[1 : ]].queue(d)
+        await jobs.put(page)
+      d += ONE_DAY
+
+    for _ in workers:
+      await jobs.put(None)
+    await asyncio.gather(*workers)
+
+  metrics.report()
+  return sorted(failures, key = lambda f: (f['date'], f['format'], f['type'])), \
+          metrics.summary()
+
+
+def write_failures(failures):
+  failures_file = Path('data' + SUFFIX + '/crawl_failures.json')
+  failures_file.parent.mkdir(exist_ok = True, parents = True)
+  with failures_file.open('w') as f:
+    json.dump(failures, f, indent = 2)
+  return failures_file
+
+
+def write_metrics(summary):
+  metrics_file = Path('data' + SUFFIX + '/crawl_metrics.json')
+  metrics_file.parent.mkdir(exist_ok = True, parents = True)
+  with metrics_file.open('w') as f:
+    json.dump(summary, f, indent = 2)
+  return metrics_file
+
+
+# Guarded so that parse_html can be imported by benchmarks/parse_html.py
+if __name__ == '__main__' and DEDUPE_EXISTING:
+  dedupe_existing(START_DATE, TODAY)
+
+elif __name__ == '__main__':
+  failures, summary = asyncio.run(crawl(START_DATE, TODAY))
+  print("CRAWL METRICS: " + '\t' + str(write_metrics(summary)))
+
+  failures_file = write_failures(failures)
+  if failures:
+    print("PAGES WITH FAILURE: " + '\t' + str(len(failures)) + '\t' + str(failures_file))
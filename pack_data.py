@@ -0,0 +1,139 @@
+from datetime import date
+from os import replace
+from pathlib import Path
+from zipfile import ZipFile, ZIP_DEFLATED
+
+# ['batting', 'bowling']
+TYPE = {'batting', 'bowling'}
+# ['test', 'odi', 't20']
+FORMAT = {'test', 'odi', 't20'}
+
+SUFFIX = ''
+
+# Years after this are still being crawled and keep their loose CSVs
+LAST_YEAR = date.today().year - 1
+
+# Extract year archives back into loose CSVs instead of packing
+UNPACK = False
+
+assert not TYPE - {'batting', 'bowling'}, "Invalid TYPE provided"
+assert not FORMAT - {'test', 'odi', 't20'}, "Invalid FORMAT provided"
+
+def get_data_dir(typ, frmt):
+  return Path('data' + SUFFIX + '/' + typ + '/' + frmt)
+
+
+def read_same_as(data_dir):
+  same_as = {}
+  same_as_file = data_dir / 'same_as.csv'
+  if same_as_file.exists():
+    with same_as_file.open('r') as f:
+      for l in f:
+        if l.strip():
+          date_str, source_date_str = l.strip().split(',')
+          same_as[date_str] = source_date_str
+  return same_as
+
+
+def write_same_as(data_dir, same_as):
+  same_as_file = data_dir / 'same_as.csv'
+  tmp_file = data_dir / 'same_as.csv.tmp'
+  with tmp_file.open('w') as f:
+    for date_str in sorted(same_as):
+      f.write(date_str + ',' + same_as[date_str] + '\n')
+  replace(tmp_file, same_as_file)
+
+
+def get_loose_files_by_year(data_dir):
+  loose_files = {}
+  for data_file in data_dir.glob('[0-9]' * 8 + '.csv'):
+    yr = data_file.name[ : 4]
+    if not yr in loose_files:
+      loose_files[yr] = []
+    loose_files[yr].append(data_file)
+  return loose_files
+
+
+def is_shadowed(name, same_as, sources):
+  # A packed day listed in same_as is never read, unless another entry reads its rows
+  date_str = name[ : -len('.csv')]
+  return date_str in same_as and date_str not in sources
+
+
+def has_shadowed_days(archive_file, same_as):
+  sources = set(same_as.values())
+  with ZipFile(archive_file) as archive:
+    return any(is_shadowed(name, same_as, sources) for name in archive.namelist())
+
+
+def pack_year(data_dir, yr, loose_files, same_as):
+  # Loose CSVs replace packed ones for the same day, and packed days now in same_as
+  # are dropped since get_data.py and build_players.py would never read them, unless
+  # they are the source of another same_as entry
+  archive_file = data_dir / (yr + '.zip')
+  tmp_file = data_dir / (yr + '.zip.tmp')
+
+  loose_names = {f.name for f in loose_files}
+  sources = set(same_as.values())
+  with ZipFile(tmp_file, 'w', compression = ZIP_DEFLATED) as new_archive:
+    if archive_file.exists():
+      with ZipFile(archive_file) as archive:
+        for name in sorted(archive.namelist()):
+          if name in loose_names or is_shadowed(name, same_as, sources):
+            continue
+          new_archive.writestr(archive.getinfo(name), archive.read(name))
+    for data_file in sorted(loose_files):
+      new_archive.write(data_file, arcname = data_file.name)
+    num_days = len(new_archive.namelist())
+  replace(tmp_file, archive_file)
+
+  # Loose CSVs take precedence over same_as, so packed days must leave it
+  packed_aliases = {f.name[ : -len('.csv')] for f in loose_files} & same_as.keys()
+  if packed_aliases:
+    for date_str in packed_aliases:
+      del same_as[date_str]
+    write_same_as(data_dir, same_as)
+
+  for data_file in loose_files:
+    data_file.unlink()
+
+  print ('\t' + str(archive_file) + '\t' + str(num_days) + ' days\t' \
+          + str(archive_file.stat().st_size) + ' bytes')
+
+
+def unpack_year(data_dir, archive_file, same_as):
+  # Existing loose CSVs and same_as entries already shadow their packed days
+  sources = set(same_as.values())
+  with ZipFile(archive_file) as archive:
+    for name in archive.namelist():
+      data_file = data_dir / name
+      if data_file.exists() or is_shadowed(name, same_as, sources):
+        continue
+      data_file.write_bytes(archive.read(name))
+  archive_file.unlink()
+  print ('\t' + str(archive_file) + '\tUNPACKED')
+
+
+for typ in TYPE:
+  for frmt in FORMAT:
+    data_dir = get_data_dir(typ, frmt)
+    if not data_dir.exists():
+      continue
+    print (frmt + ' : ' + typ)
+    same_as = read_same_as(data_dir)
+
+    if UNPACK:
+      for archive_file in sorted(data_dir.glob('[0-9]' * 4 + '.zip')):
+        unpack_year(data_dir, archive_file, same_as)
+      continue
+
+    loose_files = get_loose_files_by_year(data_dir)
+    # Archives are also rewritten to drop days since deduplicated by get_data.py
+    for archive_file in data_dir.glob('[0-9]' * 4 + '.zip'):
+      yr = archive_file.stem
+      if not yr in loose_files and has_shadowed_days(archive_file, same_as):
+        loose_files[yr] = []
+
+    for yr in sorted(loose_files):
+      if int(yr) <= LAST_YEAR:
+        pack_year(data_dir, yr, loose_files[yr], same_as)
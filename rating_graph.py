@@ -1,10 +1,16 @@
 import math
+import sys
 
-from datetime import date, timedelta, datetime
-from os import listdir
+from datetime import date, timedelta
 from pathlib import Path
 from scipy import interpolate
 
+# Player files are read with the same helpers as utils/
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'utils'))
+
+from common.dates import strings_to_dates
+from common.readers import read_players
+
 ONE_DAY = timedelta(days = 1)
 ONE_MONTH = timedelta(days = 30)
 ONE_YEAR = timedelta(days = 365)
@@ -61,32 +67,20 @@ assert DATE_POSITION < MAX_RATING and DATE_POSITION > THRESHOLD, \
 assert NUM_YEARS_TO_SHOW >= 1 and NUM_YEARS_TO_SHOW <= 5, \
             "NUM_YEARS_TO_SHOW must be between 1 and 5 years"
 
-def string_to_date(s):
-  dt = datetime.strptime(s, '%Y%m%d')
-  return date(dt.year, dt.month, dt.day)
-
 def get_player_ratings(typ, frmt, threshold, smooth = False):
   player_ratings = {}
   max_ratings = {}
-  player_files = listdir('players/' + typ + '/' + frmt)
-  for p in player_files:
+  for p, dates, _, ratings in read_players('players/' + typ + '/' + frmt):
     if len(COUNTRY_PREFIX) > 0 and not p.startswith(COUNTRY_PREFIX + '_'):
       continue
 
-    lines = []
-    with open('players/' + typ + '/' + frmt + '/' + p, 'r') as f:
-      lines += f.readlines()
-
-    min_player_date = string_to_date(lines[0].split(',')[0])
-    max_player_date = string_to_date(lines[-1].split(',')[0])
+    player_dates = strings_to_dates(dates).tolist()
+    min_player_date = player_dates[0]
+    max_player_date = player_dates[-1]
 
     # Get all ratings for a player
     full_player_ratings = {}
-    for i, l in enumerate(lines):
-      parts = l.split(',')
-      d = string_to_date(parts[0])
-
-      rating = eval(parts[2])
+    for d, rating in zip(player_dates, ratings.tolist()):
       if typ == 'allrounder' and ALLROUNDERS_GEOM_MEAN:
         rating = int(math.sqrt(rating * 1000))
       full_player_ratings[d] = rating
@@ -1,10 +1,16 @@
 import math
+import sys
 
-from datetime import date, timedelta, datetime
-from os import listdir
+from datetime import date, timedelta
 from pathlib import Path
 import numpy as np
 
+# Player files are read with the same helpers as utils/
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'utils'))
+
+from common.dates import strings_to_dates
+from common.readers import read_players
+
 ONE_DAY = timedelta(days = 1)
 
 # ['batting', 'bowling', 'allrounder']
@@ -66,10 +72,6 @@ print (str(THRESHOLD) + ' : ' + str(BIN_SIZE) + ' : ' + str(MAX_RATING))
 if AGGREGATION_WINDOW:
   print (AGGREGATION_WINDOW + ' / ' + PLAYER_AGGREGATE + ' / ' + BIN_AGGREGATE)
 
-def string_to_date(s):
-  dt = datetime.strptime(s, '%Y%m%d')
-  return date(dt.year, dt.month, dt.day)
-
 def readable_name(p):
   sep = p.find('_')
   return p[sep + 1 : ].split('.')[0].replace('_', ' ')
@@ -83,19 +85,11 @@ def full_readable_name(p):
 def get_daily_ratings():
   daily_ratings = {}
 
-  player_files = listdir('players/' + TYPE + '/' + FORMAT)
-  for p in player_files:
-    lines = []
-    with open('players/' + TYPE + '/' + FORMAT + '/' + p, 'r') as f:
-      lines += f.readlines()
-
-    for l in lines:
-      parts = l.split(',')
-      d = string_to_date(parts[0])
+  for p, dates, _, ratings in read_players('players/' + TYPE + '/' + FORMAT):
+    for d, rating in zip(strings_to_dates(dates).tolist(), ratings.tolist()):
       if d not in daily_ratings:
         daily_ratings[d] = {}
 
-      rating = eval(parts[2])
       if TYPE == 'allrounder' and ALLROUNDERS_GEOM_MEAN:
         rating = int(math.sqrt(rating * 1000))
       daily_ratings[d][p] = rating
@@ -1,13 +1,32 @@
-from common.stats import get_stats_for_list, normalize_array, fit_exp_curve, \
-                          make_distribution_normal, distribution_stats, VALID_STATS
+from common.aggregation_calendar import get_next_window_start, get_window_starts, \
+                                          get_window_start_mask, is_window_start
+from common.result_cache import load_cached_result, save_cached_result
+from common.stats import get_stats_for_list, get_stats_for_segments, normalize_array, \
+                          fit_exp_curve, make_distribution_normal, distribution_stats, \
+                          VALID_STATS
+from common.store import DailyView, NO_RATING
 
 from datetime import date, timedelta
 
+import common.stats
+import hashlib
 import numpy as np
 
 ONE_DAY = timedelta(days = 1)
 LAST_FUTURE_DATE = date(2030, 1, 1)
 
+# Days histogrammed at a time, bounding the copies made of the ratings matrix
+HISTOGRAM_BLOCK_DAYS = 4096
+
+# Results of get_single_window_distribution kept on disk across runs, keyed on their
+# parameters and the ratings in the window. Least recently used results are evicted
+# beyond WINDOW_CACHE_MAX_MB. Bump WINDOW_CACHE_VERSION when the results change.
+# Results are not cached while common.stats.SAMPLE_DISTRIBUTIONS draws random samples.
+WINDOW_CACHE = True
+WINDOW_CACHE_DIR = 'pickle/windows'
+WINDOW_CACHE_MAX_MB = 256
+WINDOW_CACHE_VERSION = 2
+
 VALID_AGGREGATIONS = {'', 'monthly', 'quarterly', 'halfyearly', \
                             'yearly', 'fiveyearly', 'decadal', '1952_1992'}
 
@@ -37,28 +56,21 @@ def get_aggregation_window_width(agg_window):
 def is_aggregation_window_start(d, agg_window):
   assert agg_window in VALID_AGGREGATIONS, "Invalid agg_window provided"
 
-  if not agg_window:
-    return True
+  return is_window_start(d, agg_window)
+
 
-  return agg_window == 'monthly' and d.day == 1 \
-      or agg_window == 'quarterly' and d.day == 1 and d.month in [1, 4, 7, 10] \
-      or agg_window == 'halfyearly' and d.day == 1 and d.month in [1, 7] \
-      or agg_window == 'yearly' and d.day == 1 and d.month == 1 \
-      or agg_window == 'fiveyearly' and d.day == 1 and d.month == 1 \
-                                        and d.year % 5 == 0 \
-      or agg_window == 'decadal' and d.day == 1 and d.month == 1 \
-                                        and d.year % 10 == 0 \
-      or agg_window == '1952_1992' and d.day == 1 and d.month == 1 \
-                                        and d.year in {1952, 1992}
+def get_aggregation_window_start_mask(dates, agg_window):
+  assert agg_window in VALID_AGGREGATIONS, "Invalid agg_window provided"
+
+  # Vectorized is_aggregation_window_start over a datetime64[D] array
+  return get_window_start_mask(dates, agg_window)
 
 
 def get_next_aggregation_window_start(d, agg_window):
   assert agg_window in VALID_AGGREGATIONS, "Invalid agg_window provided"
 
-  next_d = d + ONE_DAY
-  while not is_aggregation_window_start(next_d, agg_window):
-    next_d += ONE_DAY
-    assert next_d < LAST_FUTURE_DATE, "No next aggregation date found after " + str(d)
+  next_d = get_next_window_start(d, agg_window)
+  assert next_d and next_d < LAST_FUTURE_DATE, "No next aggregation date found after " + str(d)
   return next_d
 
 
@@ -74,22 +86,62 @@ def date_to_aggregation_date(dates, aggregation_dates):
 def get_aggregation_dates(daily_ratings, agg_window, start_date, end_date):
   assert agg_window in VALID_AGGREGATIONS, "Invalid agg_window provided"
 
-  first_date = min(daily_ratings.keys())
-  last_date = max(daily_ratings.keys())
+  first_date = max(min(daily_ratings.keys()), start_date)
+  last_date = min(max(daily_ratings.keys()), end_date)
+
+  return get_window_starts(agg_window, first_date, last_date).tolist()
+
+
+def get_store_aggregate_ratings(daily_ratings, agg_dates, date_to_agg_date, player_aggregate):
+  # One run of ratings per (bucket, player) in date order, reduced in a single pass
+  store = daily_ratings.store
+  bucket_ids = {d: i for i, d in enumerate(agg_dates)}
+  row_buckets = np.array([bucket_ids[date_to_agg_date[d]] if d in date_to_agg_date else -1 \
+                            for d in daily_ratings], dtype = np.int64)
+
+  rows = np.flatnonzero(row_buckets >= 0)
+  if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+    # A view rather than a copy when the buckets cover consecutive days
+    rows = slice(rows[0], rows[-1] + 1)
+  row_idx, cols = np.divmod(np.flatnonzero(store.ratings[rows] != NO_RATING), \
+                            store.num_players())
+  row_idx = row_idx + rows.start if isinstance(rows, slice) else rows[row_idx]
+  values = daily_ratings.values_matrix[row_idx, cols]
+  buckets = row_buckets[row_idx]
+
+  keys = buckets * store.num_players() + cols
+  order = np.argsort(keys, kind = 'stable')
+  starts = np.flatnonzero(np.diff(keys[order], prepend = -1))
+  stats = get_stats_for_segments(values[order], starts, player_aggregate).tolist()
+
+  # Players join each bucket in the order the daily views list them: by their first
+  # day in the bucket, then by value on that day, highest first for descending views
+  first = order[starts]
+  first_buckets = buckets[first]
+  first_cols = cols[first]
+  first_values = values[first].astype(np.int64)
+  if daily_ratings.descending:
+    first_values = -first_values
+  player_order = np.lexsort((first_cols, first_values, row_idx[first], first_buckets))
 
-  aggregation_dates = []
-  d = first_date
-  while d <= last_date:
-    if d >= start_date and d <= end_date and is_aggregation_window_start(d, agg_window):
-      aggregation_dates.append(d)
-    d += ONE_DAY
-
-  return aggregation_dates
+  aggregate_ratings = {d: {} for d in agg_dates}
+  players = store.players
+  first_buckets = first_buckets.tolist()
+  first_cols = first_cols.tolist()
+  for k in player_order.tolist():
+    aggregate_ratings[agg_dates[first_buckets[k]]][players[first_cols[k]]] = stats[k]
+  return aggregate_ratings
 
 
 def get_aggregate_ratings(daily_ratings, agg_dates, date_to_agg_date, player_aggregate):
   assert player_aggregate in VALID_STATS, "Invalid player_aggregate provided"
 
+  if isinstance(daily_ratings, DailyView):
+    aggregate_ratings = get_store_aggregate_ratings(daily_ratings, agg_dates, \
+                                                    date_to_agg_date, player_aggregate)
+    print("Aggregate ratings built for " + str(len(aggregate_ratings)) + " days")
+    return aggregate_ratings
+
   aggregate_buckets = {d: {} for d in agg_dates}
 
   for d in daily_ratings:
@@ -112,11 +164,79 @@ def get_aggregate_ratings(daily_ratings, agg_dates, date_to_agg_date, player_agg
   return aggregate_ratings
 
 
+def get_daily_histograms(daily_ratings, rows, bin_stops, ignore_zero_ratings):
+  # np.histogram of each store row as one (rows, bins) count matrix. Bins are closed on
+  # the left, and the last bin is also closed on the right.
+  store = daily_ratings.store
+  stops = np.asarray(bin_stops, dtype = np.float64)
+  num_bins = len(stops) - 1
+
+  counts = np.zeros((len(rows), num_bins), dtype = np.int64)
+  for start in range(0, len(rows), HISTOGRAM_BLOCK_DAYS):
+    block = rows[start : start + HISTOGRAM_BLOCK_DAYS]
+    cells = np.flatnonzero(store.ratings[block] != NO_RATING)
+    values = np.asarray(daily_ratings.values_matrix[block]).ravel()[cells]
+    if ignore_zero_ratings:
+      cells, values = cells[values > 0], values[values > 0]
+
+    bins = np.searchsorted(stops, values, side = 'right') - 1
+    bins[values == stops[-1]] = num_bins - 1
+    in_range = (bins >= 0) & (bins < num_bins)
+
+    day_bins = cells[in_range] // store.num_players() * num_bins + bins[in_range]
+    counts[start : start + len(block)] = \
+          np.bincount(day_bins, minlength = len(block) * num_bins).reshape(-1, num_bins)
+  return counts
+
+
+def get_store_aggregated_distribution(daily_ratings, agg_dates, date_to_agg_date, \
+                                      dist_aggregate, bin_stops, normalize_to, \
+                                      ignore_zero_ratings):
+  # Normalized histograms of all mapped days, reduced bin by bin over each bucket's days
+  store = daily_ratings.store
+  num_bins = len(bin_stops) - 1
+  bucket_ids = {d: i for i, d in enumerate(agg_dates)}
+  mapped = [(d, bucket_ids[b]) for d, b in date_to_agg_date.items() if b in bucket_ids]
+
+  mapped_dates = np.array([d for d, _ in mapped], dtype = 'datetime64[D]')
+  rows = np.searchsorted(store.dates, mapped_dates)
+  in_store = rows < store.num_dates()
+  in_store[in_store] = store.dates[rows[in_store]] == mapped_dates[in_store]
+  rows = rows[in_store]
+  row_buckets = np.array([b for _, b in mapped], dtype = np.int64)[in_store]
+
+  # Days of each bucket in date order, as the daily views list them
+  order = np.lexsort((rows, row_buckets))
+  rows, row_buckets = rows[order], row_buckets[order]
+  starts = np.flatnonzero(np.diff(row_buckets, prepend = -1))
+
+  counts = get_daily_histograms(daily_ratings, rows, bin_stops, ignore_zero_ratings)
+  totals = counts.sum(axis = 1, keepdims = True)
+  dists = np.zeros(counts.shape)
+  np.divide(counts * normalize_to, totals, out = dists, where = totals > 0)
+
+  bucket_stats = np.zeros((len(starts), num_bins))
+  for i in range(num_bins):
+    bucket_stats[ : , i] = get_stats_for_segments(dists[ : , i], starts, dist_aggregate)
+
+  aggregated_buckets = {d: [0] * num_bins for d in agg_dates}
+  for k, b in enumerate(row_buckets[starts].tolist()):
+    aggregated_buckets[agg_dates[b]] = bucket_stats[k].tolist()
+  return aggregated_buckets
+
+
 def get_aggregated_distribution(daily_ratings, agg_dates, date_to_agg_date, \
                                 dist_aggregate, bin_stops, normalize_to = 100, \
                                 ignore_zero_ratings = True):
   assert dist_aggregate in VALID_STATS, "Invalid dist_aggregate provided"
 
+  if isinstance(daily_ratings, DailyView):
+    aggregated_buckets = get_store_aggregated_distribution(daily_ratings, agg_dates, \
+                                                            date_to_agg_date, dist_aggregate, \
+                                                            bin_stops, normalize_to, \
+                                                            ignore_zero_ratings)
+    return aggregated_buckets, bin_stops
+
   aggregate_buckets = {d: [] for d in agg_dates}
   for d in daily_ratings:
     if not d in date_to_agg_date:
@@ -151,14 +271,46 @@ def get_aggregated_distribution(daily_ratings, agg_dates, date_to_agg_date, \
   return aggregated_buckets, bin_stops
 
 
+def get_window_rows(daily_ratings, start_date, end_date):
+  # Store rows of the days from start_date up to but excluding end_date
+  window = np.array([start_date, end_date], dtype = 'datetime64[D]')
+  return slice(*np.searchsorted(daily_ratings.store.dates, window).tolist())
+
+
+def get_window_cache_key(daily_ratings, window_rows, params):
+  # Digest of the parameters and the window's rows of the store, which covers the type,
+  # format, changed days and source data the daily ratings were loaded with
+  store = daily_ratings.store
+  digest = hashlib.sha1(repr((WINDOW_CACHE_VERSION, params, store.num_players())).encode())
+  digest.update(store.dates[window_rows])
+  digest.update(np.ascontiguousarray(store.ratings[window_rows]))
+  if daily_ratings.values_matrix is not store.ratings:
+    digest.update(np.ascontiguousarray(daily_ratings.values_matrix[window_rows]))
+  return digest.hexdigest()
+
+
 def get_single_window_distribution(daily_ratings, agg_date, agg_window, agg_type, \
                                     threshold, max_rating, bin_size, \
                                     get_percentiles = [], fit_curve = False, \
                                     rescale = False):
 
   next_d = get_next_aggregation_window_start(agg_date, agg_window)
-  date_to_agg_date = {d: agg_date for d in daily_ratings \
-                              if d >= agg_date and d < next_d}
+
+  window_key = ''
+  if isinstance(daily_ratings, DailyView):
+    window_rows = get_window_rows(daily_ratings, agg_date, next_d)
+    date_to_agg_date = {d: agg_date for d in daily_ratings.store.dates[window_rows].tolist()}
+    if WINDOW_CACHE and not common.stats.SAMPLE_DISTRIBUTIONS:
+      window_key = get_window_cache_key(daily_ratings, window_rows, \
+                                        (agg_date, agg_window, agg_type, threshold, \
+                                          max_rating, bin_size, list(get_percentiles), \
+                                          fit_curve, rescale))
+      result = load_cached_result(WINDOW_CACHE_DIR, window_key)
+      if result is not None:
+        return result
+  else:
+    date_to_agg_date = {d: agg_date for d in daily_ratings \
+                                if d >= agg_date and d < next_d}
 
   bin_stops = list(range(threshold, max_rating, bin_size)) + [max_rating]
 
@@ -222,8 +374,11 @@ def get_single_window_distribution(daily_ratings, agg_date, agg_window, agg_type
     ys_fit = [y * (bin_size / stats_bin_size) for y in ys_fit]
     fit_mean = round(exp_mean)
 
-  return bin_counts, actual_bins, all_percentiles, \
+  result = bin_counts, actual_bins, all_percentiles, \
               (skew, kurtosis), (xs_fit, ys_fit, fit_mean)
+  if window_key:
+    save_cached_result(WINDOW_CACHE_DIR, window_key, result, WINDOW_CACHE_MAX_MB * 2 ** 20)
+  return result
 
 
 def get_metrics_by_stops(aggregate_ratings, stops, dates, \
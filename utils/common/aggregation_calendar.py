@@ -0,0 +1,98 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+ONE_DAY = timedelta(days = 1)
+
+# Months between consecutive window starts, counted from January 1970. As 1970 is a
+# multiple of ten, fiveyearly and decadal windows start in years divisible by 5 and 10.
+WINDOW_MONTHS = {'monthly': 1, 'quarterly': 3, 'halfyearly': 6, 'yearly': 12, \
+                  'fiveyearly': 5 * 12, 'decadal': 10 * 12}
+# Windows starting on fixed dates instead of at regular steps
+CUSTOM_WINDOW_STARTS = {'1952_1992': [date(1952, 1, 1), date(1992, 1, 1)]}
+
+
+def to_day(d):
+  return np.datetime64(d, 'D')
+
+
+def get_days(start_date, end_date):
+  return np.arange(to_day(start_date), to_day(end_date) + 1, dtype = 'datetime64[D]')
+
+
+def get_month_starts(start_date, end_date, step_months = 1):
+  # First days of months between start_date and end_date, every step_months from 1970
+  first_month = to_day(start_date).astype('datetime64[M]')
+  if first_month.astype('datetime64[D]') < to_day(start_date):
+    first_month += 1
+  first = -(-first_month.astype(np.int64) // step_months) * step_months
+  last = to_day(end_date).astype('datetime64[M]').astype(np.int64)
+  return np.arange(first, last + 1, step_months).astype('datetime64[M]') \
+                                                .astype('datetime64[D]')
+
+
+def get_days_of_month(start_date, end_date, days_of_month):
+  # Given days of each month between start_date and end_date, skipping those a month lacks
+  months = np.arange(to_day(start_date).astype('datetime64[M]'), \
+                      to_day(end_date).astype('datetime64[M]') + 1)
+  offsets = np.asarray(days_of_month) - 1
+  days = (months.astype('datetime64[D]')[ : , None] + offsets).ravel()
+  month_ends = np.repeat((months + 1).astype('datetime64[D]'), len(offsets))
+  return days[(days < month_ends) & (days >= to_day(start_date)) & (days <= to_day(end_date))]
+
+
+def is_valid_window(agg_window):
+  return not agg_window or agg_window in WINDOW_MONTHS or agg_window in CUSTOM_WINDOW_STARTS
+
+
+def get_window_starts(agg_window, start_date, end_date):
+  # Every window start from start_date to end_date inclusive, as a datetime64[D] array
+  assert is_valid_window(agg_window), "Invalid agg_window provided"
+
+  if not agg_window:
+    return get_days(start_date, end_date)
+  if agg_window in CUSTOM_WINDOW_STARTS:
+    starts = np.array(CUSTOM_WINDOW_STARTS[agg_window], dtype = 'datetime64[D]')
+    return starts[(starts >= to_day(start_date)) & (starts <= to_day(end_date))]
+  return get_month_starts(start_date, end_date, WINDOW_MONTHS[agg_window])
+
+
+def is_window_start(d, agg_window):
+  assert is_valid_window(agg_window), "Invalid agg_window provided"
+
+  if not agg_window:
+    return True
+  if agg_window in CUSTOM_WINDOW_STARTS:
+    return d in CUSTOM_WINDOW_STARTS[agg_window]
+  return d.day == 1 and ((d.year - 1970) * 12 + d.month - 1) % WINDOW_MONTHS[agg_window] == 0
+
+
+def get_window_start_mask(dates, agg_window):
+  # is_window_start over a datetime64[D] array
+  assert is_valid_window(agg_window), "Invalid agg_window provided"
+
+  dates = np.asarray(dates, dtype = 'datetime64[D]')
+  if not agg_window:
+    return np.ones(len(dates), dtype = bool)
+  if agg_window in CUSTOM_WINDOW_STARTS:
+    return np.isin(dates, np.array(CUSTOM_WINDOW_STARTS[agg_window], dtype = 'datetime64[D]'))
+
+  months = dates.astype('datetime64[M]')
+  return (dates == months.astype('datetime64[D]')) \
+            & (months.astype(np.int64) % WINDOW_MONTHS[agg_window] == 0)
+
+
+def get_next_window_start(d, agg_window):
+  # First window start after d, or None if there is none
+  assert is_valid_window(agg_window), "Invalid agg_window provided"
+
+  if not agg_window:
+    return d + ONE_DAY
+  if agg_window in CUSTOM_WINDOW_STARTS:
+    starts = CUSTOM_WINDOW_STARTS[agg_window]
+    i = int(np.searchsorted(np.array(starts, dtype = 'datetime64[D]'), to_day(d), side = 'right'))
+    return starts[i] if i < len(starts) else None
+
+  step = WINDOW_MONTHS[agg_window]
+  month = (d.year - 1970) * 12 + d.month - 1
+  return np.datetime64((month // step + 1) * step, 'M').astype('datetime64[D]').item()
@@ -1,20 +1,64 @@
-from common.aggregation import is_aggregation_window_start
-from common.output import string_to_date
-
-from os import listdir
+from common.aggregation import is_aggregation_window_start, \
+                                get_aggregation_window_start_mask
+from common.dates import strings_to_dates
+from common.readers import read_player_archive, read_player_file
+from common.store import build_store, load_store, save_store, \
+                          load_date_rows, save_date_rows, \
+                          load_squared_ratings, save_squared_ratings, DailyView, NO_RATING
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from os import cpu_count, listdir, scandir
 from pathlib import Path
 
-import math
-import pickle
+import numpy as np
 
 SUFFIX = ''
 REBUILD_DATA = False
+# Processes used to read player files on a rebuild: 0 for one per CPU, 1 to read serially
+NUM_WORKERS = 0
+
+def get_changed_day_mask(values, present, dates, agg_window, consider_player_keys = False):
+  assert agg_window in ['', 'monthly', 'quarterly', 'halfyearly', \
+                          'yearly', 'fiveyearly', 'decadal'], \
+        "Invalid agg_window provided"
+
+  # values and present are (dates, players) matrices, one row per date in order
+  changed = np.zeros(len(dates), dtype = bool)
+  if len(dates) == 0:
+    return changed
+
+  values = np.asarray(values)
+  present = np.asarray(present)
+
+  # A day after a day with no players counts as changed, as does the first day
+  changed[0] = True
+  changed[1 : ] = ~np.any(present[ : -1], axis = 1)
+
+  both_present = present[1 : ] & present[ : -1]
+  changed[1 : ] |= np.any(both_present & (values[1 : ] != values[ : -1]), axis = 1)
+  if consider_player_keys:
+    changed[1 : ] |= np.any(present[1 : ] != present[ : -1], axis = 1)
+
+  if agg_window:
+    changed |= get_aggregation_window_start_mask(dates, agg_window)
+
+  return changed
+
 
 def get_days_with_change(daily_data, agg_window, consider_player_keys = False):
   assert agg_window in ['', 'monthly', 'quarterly', 'halfyearly', \
                           'yearly', 'fiveyearly', 'decadal'], \
         "Invalid agg_window provided"
 
+  if isinstance(daily_data, DailyView):
+    store = daily_data.store
+    changed = get_changed_day_mask(daily_data.values_matrix, store.ratings != NO_RATING, \
+                                    store.dates, agg_window, \
+                                    consider_player_keys = consider_player_keys)
+    dates = list(daily_data)
+    return {dates[i] for i in np.flatnonzero(changed)}
+
   changed_days = set()
   last_daily_data = {}
   for d in daily_data:
@@ -35,7 +79,91 @@ def get_days_with_change(daily_data, agg_window, consider_player_keys = False):
   return changed_days
 
 
-def get_daily_ratings(typ, frmt, changed_days_criteria = '', agg_window = '', \
+def get_source_fingerprint(player_dir):
+  if Path(player_dir).is_file():
+    st = Path(player_dir).stat()
+    return '1_' + str(st.st_mtime_ns) + '_' + str(st.st_size)
+
+  num_files, max_mtime, total_size = 0, 0, 0
+  with scandir(player_dir) as entries:
+    for e in entries:
+      st = e.stat()
+      num_files += 1
+      max_mtime = max(max_mtime, st.st_mtime_ns)
+      total_size += st.st_size
+  return str(num_files) + '_' + str(max_mtime) + '_' + str(total_size)
+
+
+def read_player_series(player_dir, player_files):
+  player_series = []
+  for p in player_files:
+    dates, ranks, ratings = read_player_file(player_dir + '/' + p)
+    player_series.append((p, strings_to_dates(dates), \
+                            ranks.astype(np.int16), ratings.astype(np.int16)))
+
+  return player_series
+
+
+def read_player_archive_series(archive_file):
+  return [(p, strings_to_dates(dates), ranks.astype(np.int16), ratings.astype(np.int16)) \
+            for p, dates, ranks, ratings in read_player_archive(archive_file)]
+
+
+def read_player_series_parallel(player_dir, player_files, num_workers = 0):
+  if not num_workers:
+    num_workers = cpu_count() or 1
+  num_workers = min(num_workers, len(player_files))
+
+  # Scripts run at import time, so workers must be forked rather than spawned
+  if num_workers <= 1 or 'fork' not in get_all_start_methods():
+    return read_player_series(player_dir, player_files)
+
+  # Contiguous shards keep players in listdir order once results are merged
+  shard_size = (len(player_files) + num_workers - 1) // num_workers
+  shards = [player_files[i : i + shard_size] \
+              for i in range(0, len(player_files), shard_size)]
+
+  player_series = []
+  with ProcessPoolExecutor(max_workers = num_workers, \
+                            mp_context = get_context('fork')) as executor:
+    for shard_series in executor.map(read_player_series, \
+                                      [player_dir] * len(shards), shards):
+      player_series += shard_series
+
+  return player_series
+
+
+def square_allrounder_ratings(ratings):
+  # Ratings are at most 1000, so squares fit in int32
+  ratings = np.asarray(ratings, dtype = np.int32)
+  squared = np.where(ratings == NO_RATING, NO_RATING, ratings * ratings // 1000)
+  return squared.astype(np.int16)
+
+
+def get_changed_day_rows(store, changed_days_criteria, agg_window):
+  present = store.ratings != NO_RATING
+
+  rating_change_mask = None
+  rank_change_mask = None
+  if changed_days_criteria in {'rating', 'either', 'both'}:
+    rating_change_mask = get_changed_day_mask(store.ratings, present, store.dates, agg_window)
+  if changed_days_criteria in {'rank', 'either', 'both'}:
+    rank_change_mask = get_changed_day_mask(store.ranks, present, store.dates, agg_window, \
+                                            consider_player_keys = True)
+
+  if changed_days_criteria == 'rating':
+    change_mask = rating_change_mask
+  elif changed_days_criteria == 'rank':
+    change_mask = rank_change_mask
+  elif changed_days_criteria == 'either':
+    change_mask = rating_change_mask | rank_change_mask
+  elif changed_days_criteria == 'both':
+    change_mask = rating_change_mask & rank_change_mask
+
+  return np.flatnonzero(change_mask).astype(np.int64)
+
+
+def get_ratings_store(typ, frmt, changed_days_criteria = '', agg_window = '', \
                           allrounders_geom_mean = False, rebuild_data = False, suffix = ''):
   assert typ in ['batting', 'bowling', 'allrounder'], "Invalid type provided"
   assert frmt in ['test', 'odi', 't20'], "Invalid format provided"
@@ -48,88 +176,69 @@ def get_daily_ratings(typ, frmt, changed_days_criteria = '', agg_window = '', \
   if not suffix:
     suffix = SUFFIX
 
-  pickle_filename = typ + '_' + frmt + '_' + changed_days_criteria + '_' + agg_window + '_' \
-                    + str(allrounders_geom_mean)
-  pickle_file = Path('pickle' + suffix + '/' + pickle_filename)
+  # One base entry per type and format; changed-day variants are row subsets of it
+  cache_dir = Path('pickle' + suffix + '/' + typ + '_' + frmt)
 
+  player_dir = 'players' + suffix + '/' + typ + '/' + frmt
+  # A single-archive build of players/ is read in place of the player files
+  archive_file = player_dir + '.npz'
+  if Path(archive_file).exists():
+    fingerprint = get_source_fingerprint(archive_file)
+  else:
+    assert Path(player_dir).exists(), \
+            "No player data in " + player_dir + ", run build_players.py first"
+    fingerprint = get_source_fingerprint(player_dir)
+
+  store = None
   rebuild_data = rebuild_data or REBUILD_DATA
-  if not rebuild_data and pickle_file.exists():
-    with open(pickle_file, 'rb') as f:
-      (daily_ratings, daily_ranks) = pickle.load(f)
-      print("UNPICKLED!")
+  if not rebuild_data:
+    store = load_store(cache_dir, fingerprint)
+
+  if store is not None:
+    print("MAPPED!")
 
-      print("Daily ratings data read for " + str(len(daily_ratings)) + " days" )
-      print("Daily ranks data read for " + str(len(daily_ranks)) + " days" )
+    print("Daily ratings data read for " + str(store.num_dates()) + " days" )
+    print("Daily ranks data read for " + str(store.num_dates()) + " days" )
   
   else:
-    daily_ratings = {}
-    daily_ranks = {}
-    dates_parsed = set()
-
-    player_dir = 'players' + suffix + '/' + typ + '/' + frmt
-    player_files = listdir(player_dir)
-    for p in player_files:
-      lines = []
-      with open(player_dir + '/' + p, 'r') as f:
-        lines += f.readlines()
-
-      for l in lines:
-        parts = l.split(',')
-        d = string_to_date(parts[0])
-        if d not in dates_parsed:
-          daily_ratings[d] = {}
-          daily_ranks[d] = {}
-          dates_parsed.add(d)
-
-        rating = eval(parts[2])
-        if typ == 'allrounder' and not allrounders_geom_mean:
-          rating = int(math.pow(rating, 2) / 1000)
-        daily_ratings[d][p] = rating
-
-        rank = eval(parts[1])
-        daily_ranks[d][p] = rank
-
-    daily_ratings = dict(sorted(daily_ratings.items()))
-    daily_ranks = dict(sorted(daily_ranks.items()))
-    for d in dates_parsed:
-      daily_ratings[d] = dict(sorted(daily_ratings[d].items(), \
-                                      key = lambda item: item[1], reverse = True))
-      daily_ranks[d] = dict(sorted(daily_ranks[d].items(), \
-                                      key = lambda item: item[1]))
-
-    if changed_days_criteria:
-      rating_change_days = set()
-      rank_change_days = set()
-      if changed_days_criteria in {'rating', 'either', 'both'}:
-        rating_change_days = get_days_with_change(daily_ratings, agg_window)
-      if changed_days_criteria in {'rank', 'either', 'both'}:
-        rank_change_days = get_days_with_change(daily_ranks, agg_window, \
-                                                consider_player_keys = True)
-
-      change_days = set()
-      if changed_days_criteria == 'rating':
-        change_days = rating_change_days
-      elif changed_days_criteria == 'rank':
-        change_days = rank_change_days
-      elif changed_days_criteria == 'either':
-        change_days = rating_change_days | rank_change_days
-      elif changed_days_criteria == 'both':
-        change_days = rating_change_days & rank_change_days
-
-      daily_ratings = dict(filter(lambda item: item[0] in change_days, \
-                                daily_ratings.items()))
-      daily_ranks = dict(filter(lambda item: item[0] in change_days, \
-                              daily_ranks.items()))
-
-    print("Daily ratings data built for " + str(len(daily_ratings)) + " days" )
-    print("Daily ranks data built for " + str(len(daily_ranks)) + " days" )
-    assert not daily_ratings.keys() ^ daily_ranks.keys(), \
-            "Key mismatch between daily_ratings and daily_ranks"
+    if Path(archive_file).exists():
+      store = build_store(read_player_archive_series(archive_file))
+    else:
+      player_files = listdir(player_dir)
+      store = build_store(read_player_series_parallel(player_dir, player_files, \
+                                                        num_workers = NUM_WORKERS))
+
+    print("Daily ratings data built for " + str(store.num_dates()) + " days" )
+    print("Daily ranks data built for " + str(store.num_dates()) + " days" )
     
-    pickle_file.parent.mkdir(exist_ok = True, parents = True)
-    with open(pickle_file, 'wb+') as f:
-      pickle.dump([daily_ratings, daily_ranks], f)
-      print("PICKLED!")
+    save_store(store, cache_dir, fingerprint)
+    print("CACHED!")
+
+  if typ == 'allrounder' and not allrounders_geom_mean:
+    # Squared once per base entry and mapped like the ratings themselves
+    squared = load_squared_ratings(cache_dir, fingerprint)
+    if squared is None:
+      squared = square_allrounder_ratings(store.ratings)
+      save_squared_ratings(cache_dir, squared, fingerprint)
+    store = store.with_ratings(squared)
 
-  return daily_ratings, daily_ranks
+  if changed_days_criteria:
+    rows_name = changed_days_criteria + '_' + agg_window + '_' + str(allrounders_geom_mean)
+    date_rows = load_date_rows(cache_dir, rows_name, fingerprint)
+    if date_rows is None:
+      date_rows = get_changed_day_rows(store, changed_days_criteria, agg_window)
+      save_date_rows(cache_dir, rows_name, date_rows, fingerprint)
+    store = store.select_dates(date_rows)
 
+    print("Changed days selected: " + str(store.num_dates()) + " days" )
+
+  return store
+
+
+def get_daily_ratings(typ, frmt, changed_days_criteria = '', agg_window = '', \
+                          allrounders_geom_mean = False, rebuild_data = False, suffix = ''):
+  store = get_ratings_store(typ, frmt, changed_days_criteria = changed_days_criteria, \
+                            agg_window = agg_window, \
+                            allrounders_geom_mean = allrounders_geom_mean, \
+                            rebuild_data = rebuild_data, suffix = suffix)
+  return store.daily_ratings(), store.daily_ranks()
@@ -0,0 +1,15 @@
+from datetime import date
+
+import numpy as np
+
+def string_to_date(s):
+  return date(int(s[0 : 4]), int(s[4 : 6]), int(s[6 : 8]))
+
+def strings_to_dates(strs):
+  # Bulk decoding of YYYYMMDD strings or integers to a datetime64[D] array
+  ymd = np.asarray(strs).astype(np.int64)
+  if not len(ymd):
+    return np.array([], dtype = 'datetime64[D]')
+  months = (ymd // 10000 - 1970) * 12 + ymd // 100 % 100 - 1
+  return months.astype('datetime64[M]').astype('datetime64[D]') \
+            + (ymd % 100 - 1).astype('timedelta64[D]')
@@ -1,17 +1,15 @@
+from common.aggregation_calendar import get_days, get_days_of_month, get_month_starts
+from common.dates import string_to_date, strings_to_dates
+
 from datetime import date, datetime, timedelta
 from matplotlib import cm
 from matplotlib import colors as mcolors
 
 import numpy as np
 
-ONE_DAY = timedelta(days = 1)
 ONE_MONTH = timedelta(days = 30)
 ONE_YEAR = timedelta(days = 365)
 
-def string_to_date(s):
-  dt = datetime.strptime(s, '%Y%m%d')
-  return date(dt.year, dt.month, dt.day)
-
 def date_to_string(d):
   yr = str(d.year)
   mn = str(d.month)
@@ -126,65 +124,45 @@ def resolution_by_span(start_date, end_date, prefer_wide = False):
 def get_timescale_xticks(start_date, end_date, format = 'square'):
   assert format in ['square', 'widescreen']
 
-  xticks_major, xticks_minor = [], []
   date_range = end_date - start_date
-
-  d = start_date
-  while d <= end_date:
-    if format == 'square' and date_range < ONE_MONTH or \
-        format == 'widescreen' and date_range < 2 * ONE_MONTH:
-      if d.day % 10 == 1:
-        xticks_major.append(d)
-      xticks_minor.append(d)
-    if format == 'square' and date_range < 3 * ONE_MONTH or \
-        format == 'widescreen' and date_range < 2 * 3 * ONE_MONTH:
-      if d.day == 1:
-        xticks_major.append(d)
-      if d.day % 10 == 1:
-        xticks_minor.append(d)
-    if format == 'square' and date_range < ONE_YEAR or \
-        format == 'widescreen' and date_range < 2 * ONE_YEAR:
-      if d.day == 1 and d.month % 3 == 1:
-        xticks_major.append(d)
-      if d.day == 1:
-        xticks_minor.append(d)
-    elif format == 'square' and date_range < 2 * ONE_YEAR or \
-        format == 'widescreen' and date_range < 5 * ONE_YEAR:
-      if d.day == 1 and d.month % 6 == 1:
-        xticks_major.append(d)
-      if d.day == 1:
-        xticks_minor.append(d)
-    elif format == 'square' and date_range < 5 * ONE_YEAR or \
-        format == 'widescreen' and date_range < 10 * ONE_YEAR:
-      if d.day == 1 and d.month == 1:
-        xticks_major.append(d)
-      if d.day == 1:
-        xticks_minor.append(d)
-    elif format == 'square' and date_range < 10 * ONE_YEAR or \
-        format == 'widescreen' and date_range < 20 * ONE_YEAR:
-      if d.day == 1 and d.month == 1:
-        xticks_major.append(d)
-      if d.day == 1 and d.month % 3 == 1:
-        xticks_minor.append(d)
-    elif format == 'square' and date_range < 20 * ONE_YEAR or \
-        format == 'widescreen' and date_range < 40 * ONE_YEAR:
-      if d.day == 1 and d.month == 1 and d.year % 2 == 0:
-        xticks_major.append(d)
-      if d.day == 1 and d.month == 1:
-        xticks_minor.append(d)
-    elif format == 'square' and date_range < 50 * ONE_YEAR or \
-        format == 'widescreen' and date_range < 100 * ONE_YEAR:
-      if d.day == 1 and d.month == 1 and d.year % 5 == 0:
-        xticks_major.append(d)
-      if d.day == 1 and d.month == 1:
-        xticks_minor.append(d)
-    else:
-      if d.day == 1 and d.month == 1 and d.year % 10 == 0:
-        xticks_major.append(d)
-      if d.day == 1 and d.month == 1:
-        xticks_minor.append(d)
-
-    d += ONE_DAY
+  days_1_11_21_31 = get_days_of_month(start_date, end_date, [1, 11, 21, 31])
+
+  # (major, minor) ticks from each rule that applies, merged in date order below
+  ticks = []
+  if format == 'square' and date_range < ONE_MONTH or \
+      format == 'widescreen' and date_range < 2 * ONE_MONTH:
+    ticks.append((days_1_11_21_31, get_days(start_date, end_date)))
+  if format == 'square' and date_range < 3 * ONE_MONTH or \
+      format == 'widescreen' and date_range < 2 * 3 * ONE_MONTH:
+    ticks.append((get_month_starts(start_date, end_date), days_1_11_21_31))
+  # Month steps of major and minor ticks, counted from January 1970
+  if format == 'square' and date_range < ONE_YEAR or \
+      format == 'widescreen' and date_range < 2 * ONE_YEAR:
+    major_months, minor_months = 3, 1
+  elif format == 'square' and date_range < 2 * ONE_YEAR or \
+      format == 'widescreen' and date_range < 5 * ONE_YEAR:
+    major_months, minor_months = 6, 1
+  elif format == 'square' and date_range < 5 * ONE_YEAR or \
+      format == 'widescreen' and date_range < 10 * ONE_YEAR:
+    major_months, minor_months = 12, 1
+  elif format == 'square' and date_range < 10 * ONE_YEAR or \
+      format == 'widescreen' and date_range < 20 * ONE_YEAR:
+    major_months, minor_months = 12, 3
+  elif format == 'square' and date_range < 20 * ONE_YEAR or \
+      format == 'widescreen' and date_range < 40 * ONE_YEAR:
+    major_months, minor_months = 2 * 12, 12
+  elif format == 'square' and date_range < 50 * ONE_YEAR or \
+      format == 'widescreen' and date_range < 100 * ONE_YEAR:
+    major_months, minor_months = 5 * 12, 12
+  else:
+    major_months, minor_months = 10 * 12, 12
+  ticks.append((get_month_starts(start_date, end_date, major_months), \
+                get_month_starts(start_date, end_date, minor_months)))
+
+  xticks_major = np.concatenate([major for major, _ in ticks])
+  xticks_minor = np.concatenate([minor for _, minor in ticks])
+  xticks_major = xticks_major[np.argsort(xticks_major, kind = 'stable')].tolist()
+  xticks_minor = xticks_minor[np.argsort(xticks_minor, kind = 'stable')].tolist()
 
   if format == 'square' and date_range < 2 * ONE_YEAR or \
         format == 'widescreen' and date_range < 5 * ONE_YEAR:
@@ -0,0 +1,45 @@
+from os import listdir
+from pathlib import Path
+
+import numpy as np
+
+def read_player_file(filename):
+  # Player timeline lines are YYYYMMDD,rank,rating
+  table = np.loadtxt(filename, delimiter = ',', dtype = np.int64, ndmin = 2)
+  table = table.reshape(-1, 3)
+  return table[:, 0], table[:, 1], table[:, 2]
+
+def read_player_archive(filename):
+  # Archives written by build_players.py with ARCHIVE set: rows of all players
+  # concatenated, with player i in rows offsets[i] to offsets[i + 1]
+  player_tables = []
+  with np.load(filename) as archive:
+    offsets = archive['offsets']
+    dates, ranks, ratings = archive['dates'], archive['ranks'], archive['ratings']
+    for i, p in enumerate(archive['players'].tolist()):
+      rows = slice(offsets[i], offsets[i + 1])
+      player_tables.append((p, dates[rows], ranks[rows], ratings[rows]))
+  return player_tables
+
+def read_players(player_dir):
+  # (player, dates, ranks, ratings) for each player in players/<type>/<format>, read
+  # from its archive when build_players.py was run with ARCHIVE set
+  archive_file = player_dir + '.npz'
+  if Path(archive_file).exists():
+    return read_player_archive(archive_file)
+  assert Path(player_dir).exists(), \
+          "No player data in " + player_dir + ", run build_players.py first"
+  return [(p, ) + read_player_file(player_dir + '/' + p) for p in listdir(player_dir)]
+
+def read_day_lines(lines):
+  # Daily data lines are rank,rating,name,country, where names may hold commas.
+  # Returns rank and rating arrays, and lists of raw name and country fields.
+  fields = [l.strip().split(',', 2) for l in lines]
+  ranks = np.array([f[0] for f in fields]).astype(np.int64)
+  ratings = np.array([f[1] for f in fields]).astype(np.int64)
+  names, countries = [], []
+  for f in fields:
+    name, country = f[2].rsplit(',', 1)
+    names.append(name)
+    countries.append(country)
+  return ranks, ratings, names, countries
@@ -0,0 +1,60 @@
+from os import replace, scandir, utime
+from pathlib import Path
+
+import pickle
+
+# Bytes held by each cache directory, counted on its first write by this process
+cache_sizes = {}
+
+
+def load_cached_result(cache_dir, key):
+  entry = Path(cache_dir) / (key + '.pkl')
+  try:
+    with open(entry, 'rb') as f:
+      result = pickle.load(f)
+  except (OSError, EOFError, pickle.UnpicklingError):
+    return None
+
+  # Modification time orders entries for eviction, so a hit marks one as recently used
+  utime(entry)
+  return result
+
+
+def get_cache_entries(cache_dir):
+  # (mtime, size, path) of each complete entry
+  entries = []
+  with scandir(cache_dir) as it:
+    for e in it:
+      if e.name.endswith('.pkl'):
+        st = e.stat()
+        entries.append((st.st_mtime_ns, st.st_size, e.path))
+  return entries
+
+
+def evict_cached_results(cache_dir, max_bytes):
+  # Least recently used entries go first, down to 90% of max_bytes
+  entries = sorted(get_cache_entries(cache_dir))
+  total = sum(size for _, size, _ in entries)
+  for _, size, path in entries:
+    if total <= 0.9 * max_bytes:
+      break
+    Path(path).unlink(missing_ok = True)
+    total -= size
+  cache_sizes[cache_dir] = total
+
+
+def save_cached_result(cache_dir, key, result, max_bytes):
+  cache_dir = str(cache_dir)
+  Path(cache_dir).mkdir(exist_ok = True, parents = True)
+  if cache_dir not in cache_sizes:
+    cache_sizes[cache_dir] = sum(size for _, size, _ in get_cache_entries(cache_dir))
+
+  entry = Path(cache_dir) / (key + '.pkl')
+  tmp_entry = Path(cache_dir) / (key + '.tmp')
+  with open(tmp_entry, 'wb') as f:
+    pickle.dump(result, f)
+  replace(tmp_entry, entry)
+
+  cache_sizes[cache_dir] += entry.stat().st_size
+  if cache_sizes[cache_dir] > max_bytes:
+    evict_cached_results(cache_dir, max_bytes)
@@ -8,6 +8,10 @@ import numpy as np
 VALID_STATS = {'avg', 'std', 'median', 'min', 'max', 'first', 'last', \
                       'p10', 'p20', 'p25', 'p50', 'p75', 'p80', 'p90'}
 
+# Draw random values from histograms for distribution stats and rescaling, instead of
+# computing moments exactly and spreading values evenly within each bin
+SAMPLE_DISTRIBUTIONS = False
+
 
 def get_stats_for_list(values, stat_type):
   assert stat_type in VALID_STATS, "Invalid stat_type provided"
@@ -44,6 +48,39 @@ def get_stats_for_list(values, stat_type):
     return np.percentile(values, 90, method = 'nearest')
 
 
+def get_stats_for_segments(values, starts, stat_type):
+  # get_stats_for_list for each run of values beginning at an index in starts.
+  # Runs must be non-empty and hold their values in list order.
+  assert stat_type in VALID_STATS, "Invalid stat_type provided"
+
+  values = np.asarray(values)
+  starts = np.asarray(starts, dtype = np.int64)
+  if len(starts) == 0:
+    return np.array([], dtype = values.dtype)
+  counts = np.diff(np.append(starts, len(values)))
+
+  if stat_type == 'avg':
+    return np.add.reduceat(values.astype(np.float64), starts) / counts
+  if stat_type == 'std':
+    means = np.add.reduceat(values.astype(np.float64), starts) / counts
+    deviations = values - np.repeat(means, counts)
+    return np.sqrt(np.add.reduceat(deviations * deviations, starts) / counts)
+  if stat_type == 'min':
+    return np.minimum.reduceat(values, starts)
+  if stat_type == 'max':
+    return np.maximum.reduceat(values, starts)
+  if stat_type == 'first':
+    return values[starts]
+  if stat_type == 'last':
+    return values[starts + counts - 1]
+
+  # Sort within each run and pick the element np.percentile(method = 'nearest') picks
+  percentile = 50 if stat_type == 'median' else int(stat_type[1 : ])
+  run_ids = np.repeat(np.arange(len(starts)), counts)
+  sorted_values = values[np.lexsort((values, run_ids))]
+  return sorted_values[starts + np.around((counts - 1) * (percentile / 100)).astype(np.int64)]
+
+
 def normalize_array(values, normalize_to = 100):
   if len(values) == 0:
     return []
@@ -62,31 +99,76 @@ def sample_from_distribution(bin_counts, bins, bin_width, \
   for i, b in enumerate(bins):
     vals = rng.integers(low = b, high = b + bin_width, \
                         size = round(bin_counts[i] * scale_bins))
-    scaled_vals = [(v - val_range[0]) / (val_range[1] - val_range[0]) for v in vals]
-    all_vals.append(scaled_vals)
+    all_vals.append((vals - val_range[0]) / (val_range[1] - val_range[0]))
   all_vals = np.concatenate(all_vals)
 
   return all_vals
 
 
+def get_bin_values(bins, bin_width):
+  # First value and no. of values in each bin, as drawn by sample_from_distribution
+  lows = np.trunc(np.asarray(bins, dtype = np.float64))
+  sizes = np.trunc(np.asarray(bins, dtype = np.float64) + bin_width) - lows
+  return lows, sizes
+
+
+def spread_over_distribution(bin_counts, bins, bin_width, \
+                              val_range = (0, 1), scale_bins = 1):
+  # Same values as sample_from_distribution, but spread evenly within each bin
+  counts = np.array([round(c * scale_bins) for c in bin_counts], dtype = np.int64)
+  starts = np.cumsum(counts) - counts
+  positions = np.arange(counts.sum()) - np.repeat(starts, counts)
+  lows, sizes = get_bin_values(bins, bin_width)
+  vals = np.repeat(lows, counts) \
+            + np.floor((positions + 0.5) / np.repeat(counts, counts) * np.repeat(sizes, counts))
+
+  return (vals - val_range[0]) / (val_range[1] - val_range[0])
+
+
+def distribution_moments(bin_counts, bins, bin_width):
+  # Skew and excess kurtosis sample_from_distribution converges to, computed exactly
+  weights = np.asarray(bin_counts, dtype = np.float64)
+  total = weights.sum()
+  if total <= 0:
+    return np.nan, np.nan
+
+  # Each bin is uniform over its k values, with central moments (k^2 - 1) / 12 and
+  # (k^2 - 1)(3k^2 - 7) / 240 added to those of the bin's mean
+  lows, sizes = get_bin_values(bins, bin_width)
+  deviations = lows + (sizes - 1) / 2
+  deviations -= np.dot(weights, deviations) / total
+  spread2 = (sizes ** 2 - 1) / 12
+  spread4 = (sizes ** 2 - 1) * (3 * sizes ** 2 - 7) / 240
+  m2 = np.dot(weights, deviations ** 2 + spread2) / total
+  m3 = np.dot(weights, deviations ** 3 + 3 * deviations * spread2) / total
+  m4 = np.dot(weights, deviations ** 4 + 6 * deviations ** 2 * spread2 + spread4) / total
+  if m2 <= 0:
+    return np.nan, np.nan
+
+  return m3 / m2 ** 1.5, m4 / m2 ** 2 - 3
+
+
 def distribution_stats(bin_counts, bins, bin_width, val_range, scale_bins):
+  if not SAMPLE_DISTRIBUTIONS:
+    return distribution_moments(bin_counts, bins, bin_width)
+
   sample_vals = sample_from_distribution(bin_counts, bins, bin_width, \
                                           val_range, scale_bins)
   return skew(sample_vals), kurtosis(sample_vals)
 
 
 def make_distribution_normal(bin_counts, bins, bin_width, val_range, scale_bins):
-  sampled_vals = sample_from_distribution(bin_counts, bins, bin_width, \
-                                          val_range, scale_bins)
+  get_vals = sample_from_distribution if SAMPLE_DISTRIBUTIONS else spread_over_distribution
+  sampled_vals = get_vals(bin_counts, bins, bin_width, val_range, scale_bins)
 
   normalized = power_transform(sampled_vals.reshape(-1, 1)).reshape(1, -1).flatten()
 
   val_range_size = (val_range[1] - val_range[0])
   mid_point = val_range[0] + val_range_size / 2
   sigma_size = val_range_size / 5
-  scaled_normalized = [mid_point + v * sigma_size for v in normalized]
+  scaled_normalized = mid_point + normalized * sigma_size
   
-  hist_bins = bins + [bins[-1] + bin_width]
+  hist_bins = list(bins) + [bins[-1] + bin_width]
   dist = np.histogram(scaled_normalized, bins = hist_bins)[0]
   dist = normalize_array(dist)
 
@@ -0,0 +1,180 @@
+from collections.abc import Mapping
+from os import replace
+from pathlib import Path
+
+import json
+import numpy as np
+
+# Marks a (date, player) cell with no rating in the store matrices
+NO_RATING = -1
+# File name prefixes for row indexes and squared allrounder ratings memoized next to a
+# cached store. Names end with the fingerprint of the store they were computed from.
+DATE_ROWS_PREFIX = 'rows_'
+SQUARED_RATINGS_PREFIX = 'ratings_sq'
+
+
+class RatingsStore:
+  def __init__(self, dates, players, ratings, ranks):
+    assert ratings.shape == (len(dates), len(players)), "Invalid ratings shape"
+    assert ranks.shape == ratings.shape, "Mismatch between ratings and ranks shape"
+
+    # Sorted datetime64[D] array, one row per date
+    self.dates = dates
+    # Player file names, one column per player
+    self.players = list(players)
+    # int16 matrices of shape (dates, players), NO_RATING where absent
+    self.ratings = ratings
+    self.ranks = ranks
+
+  def num_dates(self):
+    return len(self.dates)
+
+  def num_players(self):
+    return len(self.players)
+
+  def with_ratings(self, ratings):
+    return RatingsStore(self.dates, self.players, ratings, self.ranks)
+
+  def select_dates(self, date_rows):
+    return RatingsStore(self.dates[date_rows], self.players, \
+                        self.ratings[date_rows], self.ranks[date_rows])
+
+  def daily_ratings(self):
+    return DailyView(self, self.ratings, descending = True)
+
+  def daily_ranks(self):
+    return DailyView(self, self.ranks, descending = False)
+
+
+def build_store(player_series):
+  # player_series: list of (player, dates, ranks, ratings) with one array per field
+  players = [s[0] for s in player_series]
+  if player_series:
+    dates = np.unique(np.concatenate([s[1] for s in player_series]))
+  else:
+    dates = np.array([], dtype = 'datetime64[D]')
+
+  ratings = np.full((len(dates), len(players)), NO_RATING, dtype = np.int16)
+  ranks = np.full((len(dates), len(players)), NO_RATING, dtype = np.int16)
+  for j, (_, player_dates, player_ranks, player_ratings) in enumerate(player_series):
+    rows = np.searchsorted(dates, player_dates)
+    ratings[rows, j] = player_ratings
+    ranks[rows, j] = player_ranks
+
+  return RatingsStore(dates, players, ratings, ranks)
+
+
+def save_array(cache_dir, name, values):
+  # Arrays are replaced rather than rewritten in place, so processes still mapping
+  # the previous files keep reading them intact
+  tmp_file = cache_dir / (name + '.tmp.npy')
+  np.save(tmp_file, np.ascontiguousarray(values))
+  replace(tmp_file, cache_dir / (name + '.npy'))
+
+
+def save_store(store, cache_dir, fingerprint = ''):
+  cache_dir = Path(cache_dir)
+  # Replace entries left behind by the older whole-file pickle cache
+  if cache_dir.is_file():
+    cache_dir.unlink()
+  cache_dir.mkdir(exist_ok = True, parents = True)
+  # Without a header the entry reads as missing until the new one is complete
+  (cache_dir / 'header.json').unlink(missing_ok = True)
+  # Row indexes and ratings memoized against the previous matrices are no longer valid
+  for prefix in [DATE_ROWS_PREFIX, SQUARED_RATINGS_PREFIX]:
+    for f in cache_dir.glob(prefix + '*.npy'):
+      f.unlink()
+
+  save_array(cache_dir, 'ratings', store.ratings)
+  save_array(cache_dir, 'ranks', store.ranks)
+
+  # Header is written last so that its presence marks a complete entry.
+  # Dates are stored as day numbers since 1970-01-01.
+  header = {'fingerprint': fingerprint, \
+            'dates': store.dates.astype(np.int64).tolist(), 'players': store.players}
+  with open(cache_dir / 'header.json.tmp', 'w') as f:
+    json.dump(header, f)
+  replace(cache_dir / 'header.json.tmp', cache_dir / 'header.json')
+
+
+def load_store(cache_dir, fingerprint = ''):
+  cache_dir = Path(cache_dir)
+  header_file = cache_dir / 'header.json'
+  if not header_file.exists():
+    return None
+
+  with open(header_file, 'r') as f:
+    header = json.load(f)
+  if not header.get('fingerprint', '') == fingerprint:
+    print("STALE CACHE: " + str(cache_dir))
+    return None
+
+  dates = np.array(header['dates'], dtype = 'datetime64[D]')
+  ratings = np.load(cache_dir / 'ratings.npy', mmap_mode = 'r')
+  ranks = np.load(cache_dir / 'ranks.npy', mmap_mode = 'r')
+  return RatingsStore(dates, header['players'], ratings, ranks)
+
+
+def get_memo_name(prefix, name, fingerprint):
+  # A process still working from an earlier store cannot overwrite memos of a rebuilt one
+  return prefix + name + '_' + fingerprint
+
+
+def save_date_rows(cache_dir, name, date_rows, fingerprint = ''):
+  save_array(Path(cache_dir), get_memo_name(DATE_ROWS_PREFIX, name, fingerprint), date_rows)
+
+
+def load_date_rows(cache_dir, name, fingerprint = ''):
+  rows_file = Path(cache_dir) / (get_memo_name(DATE_ROWS_PREFIX, name, fingerprint) + '.npy')
+  if not rows_file.exists():
+    return None
+  return np.load(rows_file)
+
+
+def save_squared_ratings(cache_dir, ratings, fingerprint = ''):
+  save_array(Path(cache_dir), get_memo_name(SQUARED_RATINGS_PREFIX, '', fingerprint), ratings)
+
+
+def load_squared_ratings(cache_dir, fingerprint = ''):
+  ratings_file = Path(cache_dir) / (get_memo_name(SQUARED_RATINGS_PREFIX, '', fingerprint) \
+                                      + '.npy')
+  if not ratings_file.exists():
+    return None
+  return np.load(ratings_file, mmap_mode = 'r')
+
+
+# Read-only {date: {player: value}} view over one store matrix, matching the
+# dicts of dicts that get_daily_ratings used to return.
+class DailyView(Mapping):
+  def __init__(self, store, values, descending):
+    self.store = store
+    self.values_matrix = values
+    self.descending = descending
+
+    self._dates = store.dates.astype(object).tolist()
+    self._rows = {d: i for i, d in enumerate(self._dates)}
+    self._last_row = (-1, None)
+
+  def __getitem__(self, d):
+    i = self._rows[d]
+    if self._last_row[0] == i:
+      return self._last_row[1]
+
+    row = self.values_matrix[i]
+    cols = np.flatnonzero(self.store.ratings[i] != NO_RATING)
+    row_values = row[cols].astype(np.int32)
+    order = np.argsort(-row_values if self.descending else row_values, kind = 'stable')
+
+    players = self.store.players
+    day = dict(zip([players[c] for c in cols[order]], row_values[order].tolist()))
+    self._last_row = (i, day)
+    return day
+
+  def __contains__(self, d):
+    return d in self._rows
+
+  def __iter__(self):
+    return iter(self._dates)
+
+  def __len__(self):
+    return len(self._dates)
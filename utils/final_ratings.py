@@ -1,7 +1,7 @@
 from common.output import string_to_date, date_to_string, readable_name_and_country
+from common.readers import read_players
 
 from datetime import date
-from os import listdir
 
 # ['batting', 'bowling', 'allrounder']
 TYPE = 'batting'
@@ -23,29 +23,17 @@ if BY_FINAL_RANK:
 
 def get_last_ratings(players_dir):
   final_ratings = {}
-  player_files = listdir(players_dir)
 
   max_d = EPOCH
-  for p in player_files:
-    lines = []
-    with open(players_dir + '/' + p, 'r') as f:
-      lines += f.readlines()
-
-    min_rank = 100
-    max_rating = 0
-    for l in lines:
-      parts = l.split(',')
-      d = string_to_date(parts[0])
-      if d > max_d:
-        max_d = d
-
-      rating = eval(parts[2])
-      if rating > max_rating:
-        max_rating = rating
-
-      rank = eval(parts[1])
-      if rank < min_rank:
-        min_rank = rank
+  for p, dates, ranks, ratings in read_players(players_dir):
+    d = string_to_date(str(dates[-1]))
+    max_d = max(max_d, string_to_date(str(dates.max())))
+
+    rating = int(ratings[-1])
+    max_rating = max(0, int(ratings.max()))
+
+    rank = int(ranks[-1])
+    min_rank = min(100, int(ranks.min()))
 
     final_ratings[p] = {'last_date': d, 'rank': rank, 'final': rating, \
                         'max_rating': max_rating, 'min_rank': min_rank}